@@ -2,53 +2,148 @@
 
 import json
 import os
-import threading
+import re
+import sys
 import time
 import traceback
-from collections import namedtuple
-from configparser import ConfigParser
-from urllib.request import urlretrieve
+from collections import deque, namedtuple
 # from apscheduler.schedulers.background import BackgroundScheduler
 
-from cqsdk import CQBot, CQAt, CQImage, RcvdPrivateMessage, RcvdGroupMessage
-from utils import CQ_IMAGE_ROOT, error, reply
+from cqsdk import CQBot, CQAt, QQArg, Segment, RcvdPrivateMessage, \
+    RcvdGroupMessage
+from imagestore import ImageStore
+from msglog import MessageLog
+from msgsearch import SearchIndex
+from utils import CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA, downloader, error, \
+    reply
 
-qqbot = CQBot(11235)
+qqbot = CQBot(11235, workers=4)
 POI_GROUP = '378320628'
+image_store = ImageStore(CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA)
+downloader.store = image_store
 
 with open('admin.json', 'r', encoding="utf-8") as f:
     data = json.loads(f.read())
     ADMIN = data
+    qqbot.admins.update(ADMIN)
 
 
 Message = namedtuple('Manifest', ('qq', 'time', 'text'))
-messages = []
 
+HISTORY_DEPTH = 100  # messages per QQ
+HISTORY_AGE = 7 * 24 * 3600  # seconds
+HISTORY_LIMIT = 64 * 1024 * 1024  # bytes
+
+
+class Ring:
+    # Fixed size ring buffer, O(1) access to the n-th most recent item.
+    __slots__ = ('items', 'start', 'size')
+
+    def __init__(self, depth):
+        self.items = [None] * depth
+        self.start = 0
+        self.size = 0
+
+    def append(self, item):
+        depth = len(self.items)
+        if self.size == depth:
+            self.items[self.start] = item
+            self.start = (self.start + 1) % depth
+        else:
+            self.items[(self.start + self.size) % depth] = item
+            self.size += 1
+
+    def oldest(self):
+        return self.items[self.start] if self.size > 0 else None
+
+    def popleft(self):
+        item = self.items[self.start]
+        self.items[self.start] = None
+        self.start = (self.start + 1) % len(self.items)
+        self.size -= 1
+        return item
+
+    def recent(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        return self.items[(self.start + self.size - 1 - i) % len(self.items)]
+
+
+class History:
+    def __init__(self, depth, age, limit):
+        self.depth = depth
+        self.age = age
+        self.limit = limit
+        self.rings = {}  # qq -> Ring
+        self.order = deque()  # all messages, oldest first
+        self.bytes = 0
+
+    def add(self, message):
+        ring = self.rings.get(message.qq)
+        if ring is None:
+            ring = self.rings[message.qq] = Ring(self.depth)
+        ring.append(message)
+        self.order.append(message)
+        self.bytes += sys.getsizeof(message.text)
+        self.expire(message.time)
+
+    def expire(self, now):
+        while self.order and (self.bytes > self.limit or
+                              self.order[0].time < now - self.age):
+            message = self.order.popleft()
+            self.bytes -= sys.getsizeof(message.text)
+            ring = self.rings[message.qq]
+            # Otherwise it has been pushed out of the ring already.
+            if ring.oldest() is message:
+                ring.popleft()
+            if ring.size == 0:
+                del self.rings[message.qq]
+
+    def get(self, qq, i):
+        ring = self.rings.get(qq)
+        if ring is None:
+            raise IndexError(i)
+        return ring.recent(i)
+
+history = History(HISTORY_DEPTH, HISTORY_AGE, HISTORY_LIMIT)
+
+# Older messages, kept across restarts
+LOG_PATH = './awdlog'
+log = MessageLog(LOG_PATH)
+index = SearchIndex(log)
+
+
+def recent(qq, i):
+    try:
+        return history.get(qq, i)
+    except IndexError:
+        return log.recent(qq, i)
 
-@qqbot.listener((RcvdGroupMessage, ))
+
+@qqbot.listener((RcvdGroupMessage, ), exclude_group=POI_GROUP)
 def blacklist(message):
-    return message.group != POI_GROUP
+    return True
 
 
-@qqbot.listener((RcvdGroupMessage, RcvdPrivateMessage))
-def command(message):
-    # Restrict to admin
-    if message.qq not in ADMIN:
-        return
-    # Parse message
-    try:
-        texts = message.text.split()
-        cmd = texts[0]
-        qq = texts[1]
-        idx = texts[2:]
-    except:
-        return
-    if cmd != '/awd':
+@qqbot.command('/awd', (RcvdGroupMessage, RcvdPrivateMessage), admin=True)
+def command(message, args):
+    if not (len(args) > 0 and isinstance(args[0], str)):
         return
+    qq = args[0]
+    idx = args[1:]
+    if qq == 'search':
+        return search(message, idx)
+    if qq == 'store':
+        reply(qqbot, message, "[awd] store\n" + '\n'.join(
+            "{}: {}".format(*item) for item in image_store.stats().items()))
+        return True
+    if qq == 'stats':
+        reply(qqbot, message, "[awd] stats\n" + '\n'.join(
+            "{}.{}: {}".format(name, key, value)
+            for (name, stats) in sorted(qqbot.stats().items())
+            for (key, value) in stats.items()))
+        return True
 
-    match = CQAt.PATTERN.fullmatch(qq)
-    if match and match.group(1):
-        qq = match.group(1)
     try:
         idx = list(map(lambda x: int(x), idx))
     except:
@@ -56,50 +151,81 @@ def command(message):
     if len(idx) == 0:
         idx = [0]
 
-    items = list(filter(lambda x: x.qq == qq, messages))
-    items.reverse()
     for i in idx:
         try:
-            item = items[i]
-        except:
+            item = recent(qq, i)
+        except (IndexError, ValueError):
             continue
         reply(qqbot, message, "[awd] {qq} #{i}\n{text}".format(
                 i=i, qq=CQAt(item.qq), text=item.text))
 
 
+SEARCH_LIMIT = 5
+SEARCH_SINCE = re.compile(r'since=(\d+)([hd])')
+SEARCH_UNITS = {'h': 3600, 'd': 86400}
+
+
+def search(message, args):
+    # /awd search <keywords...> [qq=<qq>|@qq] [since=<n>h|<n>d]
+    terms = []
+    qq = None
+    since = None
+    for arg in args:
+        if isinstance(arg, QQArg):
+            qq = arg
+        elif isinstance(arg, Segment):
+            continue
+        elif arg.startswith('qq='):
+            qq = arg[3:]
+        elif SEARCH_SINCE.fullmatch(arg):
+            n, unit = SEARCH_SINCE.fullmatch(arg).groups()
+            since = int(time.time()) - int(n) * SEARCH_UNITS[unit]
+        else:
+            terms.append(arg)
+    try:
+        results = index.search(terms, qq=qq, since=since, limit=SEARCH_LIMIT)
+    except ValueError:
+        results = []
+
+    texts = ["[awd] search: {}".format(' '.join(terms))]
+    for item in results:
+        texts.append("{qq} {time}\n{text}".format(
+            qq=CQAt(item.qq),
+            time=time.strftime("%Y-%m-%d %H:%M", time.localtime(item.time)),
+            text=item.text))
+    if not results:
+        texts.append("No result.")
+    reply(qqbot, message, '\n'.join(texts))
+    return True
+
+
 @qqbot.listener((RcvdGroupMessage, ))
 def new(message):
-    messages.append(Message(message.qq, int(time.time()), message.text))
+    now = int(time.time())
+    history.add(Message(message.qq, now, message.text))
+    index.append(message.group, message.qq, now, message.text,
+                 message.segments)
 
-    for match in CQImage.PATTERN.finditer(message.text):
+    for segment in message.segments:
+        if segment.type != 'image':
+            continue
         try:
-            filename = match.group(1)
-            ImageDownloader(filename).start()
+            download_image(segment.data['file'])
         except:
             error(message)
             traceback.print_exc()
 
 
-class ImageDownloader(threading.Thread):
-    def __init__(self, filename, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.filename = filename
-
-    def run(self):
-        try:
-            path = os.path.join(CQ_IMAGE_ROOT, self.filename)
-            if os.path.exists(path):
-                return
-
-            cqimg = os.path.join(CQ_IMAGE_ROOT, self.filename+'.cqimg')
-            parser = ConfigParser()
-            parser.read(cqimg)
+def download_image(filename):
+    path = os.path.join(CQ_IMAGE_ROOT, filename)
+    if os.path.exists(path):
+        image_store.touch(path)
+        return
 
-            url = parser['image']['url']
-            urlretrieve(url, path)
-        except:
-            error(self.filename)
-            traceback.print_exc()
+    url = image_store.cqimg_url(path)
+    if url is None:
+        return
+    downloader.download(url, path)
 
 
 if __name__ == '__main__':
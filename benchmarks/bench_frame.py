@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Measure frames/sec of cqsdk.load_frame / dump_frame for every frame type.
+#   python3 benchmarks/bench_frame.py [number]
+
+import itertools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cqsdk import load_frame, dump_frame, encode_str, EncodedText, \
+    ClientHello, GroupBan, Fatal, \
+    SendPrivateMessage, SendGroupMessage, SendDiscussMessage  # noqa: E402
+
+
+TEXT = "[CQ:at,qq=412632991] 今天的演习对手是谁？poi 又白屏了…" * 4
+
+SEND_FRAMES = (
+    ClientHello(11235),
+    SendPrivateMessage("412632991", TEXT),
+    SendGroupMessage("378320628", TEXT),
+    SendDiscussMessage("123456789", TEXT),
+    GroupBan("378320628", "412632991", 60),
+    Fatal(TEXT),
+)
+
+RCVD_DATA = (
+    "ServerHello",
+    dump_frame(SendPrivateMessage("412632991", TEXT)),
+    dump_frame(SendGroupMessage("378320628", TEXT)).replace(
+        "GroupMessage 378320628", "GroupMessage 378320628 412632991", 1),
+    dump_frame(SendDiscussMessage("123456789", TEXT)).replace(
+        "DiscussMessage 123456789", "DiscussMessage 123456789 412632991", 1),
+    "GroupMemberDecrease 378320628 412632991 694692391",
+    "GroupMemberIncrease 378320628 412632991 694692391",
+)
+
+
+def bench(name, func, number, frames=1):
+    elapsed = min(timeit.repeat(func, number=number, repeat=3))
+    print("{:<32} {:>12,.0f} frames/sec".format(
+        name, number * frames / elapsed))
+
+
+def main(number=100000):
+    for data in RCVD_DATA:
+        data = data.encode()
+        prefix = data.split()[0].decode()
+        bench("load_frame " + prefix, lambda: load_frame(data), number)
+        if prefix.endswith("Message"):
+            bench("load_frame " + prefix + ".text",
+                  lambda: load_frame(data).text, number)
+    for frame in SEND_FRAMES:
+        name = type(frame).__name__
+        bench("dump_frame " + name, dump(frame), number)
+    # A new text to 20 groups: encoded per frame, via the LRU, or once.
+    for (name, wrap, uncached) in (("uncached", str, True),
+                                   ("str", str, False),
+                                   ("EncodedText", EncodedText, False)):
+        bench("fan-out x20 " + name, fanout(wrap, 20, uncached),
+              number // 20, 20)
+
+
+def dump(frame):
+    # The same text every time would only measure hits of the LRU.
+    if not hasattr(frame, 'text'):
+        return lambda: dump_frame(frame)
+
+    def run():
+        encode_str.cache_clear()
+        dump_frame(frame)
+    return run
+
+
+def fanout(wrap, targets, uncached):
+    counter = itertools.count()
+
+    def run():
+        text = wrap(TEXT + str(next(counter)))
+        for group in range(targets):
+            if uncached:
+                encode_str.cache_clear()
+            dump_frame(SendGroupMessage(group, text))
+    return run
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+# Compare matcher.KeywordMatcher with a `keyword in text` loop.
+#   python3 benchmarks/bench_matcher.py [keywords] [messages]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from matcher import KeywordMatcher  # noqa: E402
+
+
+CHARS = "的一是不了人我在有他这为之大来以个中上们到说国和地也子时道出" \
+        "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def random_text(rng, lower, upper):
+    return ''.join(rng.choice(CHARS) for _ in range(rng.randint(lower, upper)))
+
+
+def naive(text, keywords):
+    return {keyword for keyword in keywords if keyword in text}
+
+
+def bench(name, func, texts):
+    start = time.perf_counter()
+    for text in texts:
+        func(text)
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>12,.0f} messages/sec".format(name, len(texts) / elapsed))
+
+
+def main(n_keywords=10000, n_messages=2000):
+    rng = random.Random(0)
+    keywords = [random_text(rng, 3, 8) for _ in range(n_keywords)]
+    texts = [random_text(rng, 10, 80) for _ in range(n_messages)]
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher()
+    for keyword in keywords:
+        matcher.add(keyword, keyword)
+    matcher.build()
+    print("build {:,} keywords     {:>12.3f} sec".format(
+        n_keywords, time.perf_counter() - start))
+
+    for text in texts[:100]:
+        assert matcher.search(text) == naive(text, keywords)
+    bench("KeywordMatcher", matcher.search, texts)
+    bench("keyword in text", lambda text: naive(text, keywords), texts)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
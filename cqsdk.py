@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 
+import asyncio
+import binascii
+import functools
+import heapq
+import itertools
+import queue
 import re
 import socket
 import socketserver
@@ -7,21 +13,98 @@ import sys
 import threading
 import time
 import traceback
-from base64 import b64encode, b64decode
+import unicodedata
+from base64 import b64encode
 from collections import namedtuple
 
 
+class TextFrame():
+    # Received message which behaves like a namedtuple of its `_fields`.
+    # Frames loaded from a datagram keep the base64 text as a memoryview
+    # slice and only decode it on first access of `text`. `segments` and
+    # `args` are parsed from the text once and shared by all listeners.
+    __slots__ = ('_raw', '_text', '_segments', '_args')
+    _fields = ('text', )
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self._fields, args), **kwargs)
+        for field in self._fields[:-1]:
+            setattr(self, field, values[field])
+        self._raw = None
+        self._text = values['text']
+        self._segments = None
+        self._args = None
+
+    @classmethod
+    def load(cls, fields, raw):
+        frame = cls.__new__(cls)
+        for (field, value) in zip(cls._fields, fields):
+            setattr(frame, field, value)
+        frame._raw = raw
+        frame._text = None
+        frame._segments = None
+        frame._args = None
+        return frame
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = decode_text(self._raw)
+        return self._text
+
+    @property
+    def segments(self):
+        if self._segments is None:
+            self._segments = parse_cq(self.text)
+        return self._segments
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = split_args(self.segments)
+        return self._args
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(field, value)
+            for (field, value) in zip(self._fields, self)))
+
+    def _replace(self, **kwargs):
+        return type(self)(**dict(zip(self._fields, self), **kwargs))
+
+
+def text_frame(name, fields):
+    return type(name, (TextFrame, ), {
+        '__slots__': fields,
+        '_fields': fields + ('text', ),
+    })
+
+
 ClientHello = namedtuple("ClientHello", ("port"))
 ServerHello = namedtuple("ServerHello", ())
 
-RcvdPrivateMessage = namedtuple("RcvdPrivateMessage", ("qq", "text"))
+RcvdPrivateMessage = text_frame("RcvdPrivateMessage", ("qq", ))
 SendPrivateMessage = namedtuple("SendPrivateMessage", ("qq", "text"))
 
-RcvdGroupMessage = namedtuple("RcvdGroupMessage", ("group", "qq", "text"))
+RcvdGroupMessage = text_frame("RcvdGroupMessage", ("group", "qq"))
 SendGroupMessage = namedtuple("SendGroupMessage", ("group", "text"))
 
-RcvdDiscussMessage = namedtuple("RcvdDiscussMessage",
-                                ("discuss", "qq", "text"))
+RcvdDiscussMessage = text_frame("RcvdDiscussMessage", ("discuss", "qq"))
 SendDiscussMessage = namedtuple("SendDiscussMessage",
                                 ("discuss", "text"))
 
@@ -47,6 +130,68 @@ FRAME_TYPES = (
 )
 
 RE_CQ_SPECIAL = re.compile(r'\[CQ:\w+(,.+?)?\]')
+RE_CQ_CODE = re.compile(r'\[CQ:(\w+)((?:,[^\],]*)*)\]')
+CQ_ESCAPE = str.maketrans({'&': '&amp;', '[': '&#91;', ']': '&#93;',
+                           ',': '&#44;'})
+RE_CQ_UNESCAPE = re.compile(r'&(amp|#91|#93|#44);')
+CQ_UNESCAPE = {'amp': '&', '#91': '[', '#93': ']', '#44': ','}
+
+
+class Segment(namedtuple("Segment", ("type", "data", "text"))):
+    # A run of plain text (type 'text', empty data) or one CQ code such
+    # as at, image or face, with its unescaped parameters in `data`.
+    # `text` is the source of the segment.
+    __slots__ = ()
+
+    @classmethod
+    def code(cls, type_, **data):
+        params = ''.join(
+            ",{}={}".format(key, str(value).translate(CQ_ESCAPE))
+            for (key, value) in data.items())
+        return cls(type_, data, "[CQ:{}{}]".format(type_, params))
+
+    def __str__(self):
+        return self.text
+
+
+def parse_cq(text):
+    segments = []
+    pos = 0
+    for match in RE_CQ_CODE.finditer(text):
+        if match.start() > pos:
+            segments.append(Segment('text', {}, text[pos:match.start()]))
+        data = {}
+        for param in match.group(2)[1:].split(',') if match.group(2) else ():
+            (key, _, value) = param.partition('=')
+            data[key] = RE_CQ_UNESCAPE.sub(
+                lambda m: CQ_UNESCAPE[m.group(1)], value)
+        segments.append(Segment(match.group(1), data, match.group(0)))
+        pos = match.end()
+    if pos < len(text):
+        segments.append(Segment('text', {}, text[pos:]))
+    return tuple(segments)
+
+
+def split_args(segments):
+    # Words of the plain text, with every CQ code a Segment of its own.
+    args = []
+    for segment in segments:
+        if segment.type == 'text':
+            args.extend(segment.text.split())
+        else:
+            args.append(segment)
+    return tuple(args)
+
+
+def at_qq(arg):
+    if isinstance(arg, Segment) and arg.type == 'at':
+        return arg.data.get('qq')
+    return None
+
+
+def build(*parts):
+    # Join text, Segment, CQAt, CQImage ... into an outbound message.
+    return ''.join(map(str, parts))
 
 
 class CQAt:
@@ -69,81 +214,565 @@ class CQImage:
         return "[CQ:image,file={}]".format(self.file)
 
 
+RCVD_TEXT_TYPES = (RcvdPrivateMessage, RcvdGroupMessage, RcvdDiscussMessage)
+SEND_TEXT_TYPES = (SendPrivateMessage, SendGroupMessage, SendDiscussMessage,
+                   Fatal)
+
+
+def decode_text(text):
+    # Decoded lazily after the frame is dispatched, so a bad payload must
+    # not raise in a listener (or in repr); undecodable bytes become U+FFFD.
+    try:
+        data = binascii.a2b_base64(text)
+    except binascii.Error:
+        print("Bad message text", bytes(text), file=sys.stderr)
+        return ''
+    return data.decode('gbk', errors='replace')
+
+
+class EncodedText:
+    # Text whose payload is encoded once and shared by every frame it is
+    # sent in, see CQBot.broadcast.
+    __slots__ = ('text', 'payload')
+
+    def __init__(self, text):
+        self.text = str(text)
+        self.payload = encode_str(self.text)
+
+    def __str__(self):
+        return self.text
+
+    def __len__(self):
+        return len(self.text)
+
+    def __repr__(self):
+        return repr(self.text)
+
+
+# Look-alikes for characters GBK lacks.
+GBK_SUBSTITUTES = {
+    '・': '·',
+    '✕': '×',
+    '♪': '',
+}
+GBK_FALLBACK = '?'
+
+
+class GBKTable(dict):
+    # str.translate table which only holds the code points seen so far.
+    # A new one is resolved once: kept if GBK has it, else a preset from
+    # GBK_SUBSTITUTES, its NFKC form (half-width kana), or GBK_FALLBACK.
+    def __init__(self, substitutes, fallback):
+        super().__init__({ord(c): s for (c, s) in substitutes.items()})
+        self.fallback = fallback
+        self.substitutions = 0
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        value = codepoint
+        try:
+            char.encode('gbk')
+        except UnicodeEncodeError:
+            value = unicodedata.normalize('NFKC', char)
+            try:
+                value.encode('gbk')
+            except UnicodeEncodeError:
+                value = self.fallback
+        self[codepoint] = value
+        return value
+
+    def substituted(self, text):
+        return sum(1 for c in text if self[ord(c)] != ord(c))
+
+
+GBK_TABLE = GBKTable(GBK_SUBSTITUTES, GBK_FALLBACK)
+
+
+def gbk_safe(text):
+    try:
+        text.encode('gbk')
+        return text
+    except UnicodeEncodeError:
+        pass
+    GBK_TABLE.substitutions += GBK_TABLE.substituted(text)
+    return text.translate(GBK_TABLE)
+
+
+# Repeated replies (FAQ, roll) hit the cache instead of re-encoding.
+@functools.lru_cache(maxsize=128)
+def encode_str(text):
+    return b64encode(gbk_safe(text).encode('gbk')).decode()
+
+
+def encode_text(text):
+    if isinstance(text, EncodedText):
+        return text.payload
+    return encode_str(str(text))
+
+
+def make_decoder(rcvd):
+    # Decoders take the datagram and the offset of the first field.
+    if rcvd in RCVD_TEXT_TYPES:
+        count = len(rcvd._fields) - 1
+
+        def decoder(data, start):
+            fields = []
+            for i in range(count):
+                end = data.index(b' ', start)
+                fields.append(data[start:end].decode())
+                start = end + 1
+            return rcvd.load(fields, memoryview(data)[start:])
+    else:
+        def decoder(data, start):
+            return rcvd(*data[start:].decode().split())
+    return decoder
+
+
+def make_encoder(prefix, send):
+    if send in SEND_TEXT_TYPES:
+        def encoder(frame):
+            (*fields, text) = frame
+            return " ".join((prefix, *map(str, fields), encode_text(text)))
+    else:
+        def encoder(frame):
+            return " ".join((prefix, *map(str, frame)))
+    return encoder
+
+
+# Precompiled codec tables: prefix -> decoder, frame type -> encoder
+DECODERS = {type_.prefix.encode(): make_decoder(type_.rcvd)
+            for type_ in FRAME_TYPES if type_.rcvd}
+ENCODERS = {type_.send: make_encoder(type_.prefix, type_.send)
+            for type_ in FRAME_TYPES if type_.send}
+
+
 def load_frame(data):
     if isinstance(data, str):
-        parts = data.split()
+        data = data.encode()
     elif isinstance(data, list):
-        parts = data
-    else:
+        data = ' '.join(data).encode()
+    elif not isinstance(data, (bytes, bytearray)):
         raise TypeError()
 
-    frame = None
-    (prefix, *payload) = parts
-    for type_ in FRAME_TYPES:
-        if prefix == type_.prefix:
-            frame = type_.rcvd(*payload)
-    # decode text
-    if isinstance(frame, (
-            RcvdPrivateMessage, RcvdGroupMessage, RcvdDiscussMessage)):
-        payload[-1] = b64decode(payload[-1]).decode('gbk')
-        frame = type(frame)(*payload)
-    return frame
+    data = data.strip()
+    end = data.find(b' ')
+    if end < 0:
+        end = len(data)
+    decoder = DECODERS.get(data[:end])
+    if decoder is None:
+        return None
+    return decoder(data, end + 1)
 
 
 def dump_frame(frame):
     if not isinstance(frame, (tuple, list)):
         raise TypeError()
 
-    # Cast all payload fields to string
-    payload = list(map(lambda x: str(x), frame))
+    encoder = ENCODERS.get(type(frame))
+    if encoder is None:
+        # Subclass of a frame type, fall back to slow lookup.
+        for send, encoder in ENCODERS.items():
+            if isinstance(frame, send):
+                break
+        else:
+            return None
+    return encoder(frame)
 
-    # encode text
-    if isinstance(frame, (
-            SendPrivateMessage, SendGroupMessage, SendDiscussMessage, Fatal)):
-        payload[-1] = b64encode(payload[-1].encode('gbk')).decode()
 
-    data = None
-    for type_ in FRAME_TYPES:
-        if isinstance(frame, type_.send):
-            data = " ".join((type_.prefix, *payload))
-    return data
+def to_set(values):
+    if values is None:
+        return None
+    if isinstance(values, (str, int)):
+        values = (values, )
+    return frozenset(map(str, values))
 
 
 class FrameListener():
-    def __init__(self, handler, frame_type):
+    def __init__(self, handler, frame_type, group=None, qq=None,
+                 exclude_group=None, exclude_qq=None):
         self.handler = handler
         self.frame_type = frame_type
+        self.group = to_set(group)
+        self.qq = to_set(qq)
+        self.exclude_group = to_set(exclude_group)
+        self.exclude_qq = to_set(exclude_qq)
+
+    def accepts(self, frame_class, group):
+        if not issubclass(frame_class, self.frame_type):
+            return False
+        if self.group is not None and group not in self.group:
+            return False
+        if self.exclude_group is not None and group in self.exclude_group:
+            return False
+        return True
+
+    def accepts_qq(self, qq):
+        if self.qq is not None and qq not in self.qq:
+            return False
+        if self.exclude_qq is not None and qq in self.exclude_qq:
+            return False
+        return True
+
+
+class Router():
+    def __init__(self):
+        self.listeners = []
+        # (frame class, group) -> listeners accepting it, in listen order
+        self.routes = {}
+
+    def add(self, listener):
+        self.listeners.append(listener)
+        self.routes = {}
+
+    def compile(self, key):
+        routes = tuple(
+            (listener, listener.qq is not None or
+                listener.exclude_qq is not None)
+            for listener in self.listeners
+            if listener.accepts(*key))
+        self.routes[key] = routes
+        return routes
+
+    def route(self, message):
+        key = (type(message), getattr(message, "group", None))
+        routes = self.routes.get(key)
+        if routes is None:
+            routes = self.compile(key)
+        qq = getattr(message, "qq", None)
+        for listener, check_qq in routes:
+            if check_qq and not listener.accepts_qq(qq):
+                continue
+            yield listener
+
+
+class QQArg(str):
+    # QQ number given as [CQ:at,qq=...] in command arguments.
+    pass
+
+
+class CommandTable():
+    # All slash commands behind one listener: a dict lookup on the first
+    # argument, and nothing but a prefix check for other messages.
+    def __init__(self, admins):
+        self.admins = admins
+        self.commands = {}  # name -> (handler, frame_type, admin)
+
+    def add(self, name, handler, frame_type, admin):
+        self.commands[name] = (handler, frame_type, admin)
+
+    def __call__(self, message):
+        if not message.text.lstrip().startswith('/'):
+            return
+        (name, *args) = message.args
+        command = self.commands.get(name)
+        if command is None:
+            return
+        (handler, frame_type, admin) = command
+        if not isinstance(message, frame_type):
+            return
+        if admin and message.qq not in self.admins:
+            return
+        args = [QQArg(at_qq(arg)) if at_qq(arg) else arg for arg in args]
+        return handler(message, args)
 
 
-class APIRequestHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        data = self.request[0].decode()
-        parts = data.split()
+def parse_frame(data):
+    try:
+        message = load_frame(data)
+    except:
+        message = None
+    if message is None:
+        print("Unknown message", data, file=sys.stderr)
+    return message
+
 
+def dispatch(router, message):
+    for listener in router.route(message):
         try:
-            message = load_frame(parts)
+            if listener.handler(message):
+                break
         except:
-            message = None
-        if message is None:
-            print("Unknown message", parts, file=sys.stderr)
-            return
+            traceback.print_exc()
+
+
+def frame_key(message):
+    # Frames sharing a key are handled in order by the same worker.
+    for field in ("group", "discuss", "qq"):
+        value = getattr(message, field, None)
+        if value is not None:
+            return (field, value)
+    return None
 
-        for listener in self.server.listeners:
+
+class Dispatcher():
+    def __init__(self, router, workers=4, queue_size=1000):
+        self.router = router
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.dispatched = 0
+        self.dropped = 0
+
+    def start(self):
+        for q in self.queues:
+            threaded_worker = threading.Thread(
+                target=self.worker,
+                args=(q, ),
+                daemon=True)
+            threaded_worker.start()
+
+    def submit(self, message):
+        key = frame_key(message)
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put_nowait(message)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            print("Dropped message", message, file=sys.stderr)
+
+    def worker(self, q):
+        while True:
+            message = q.get()
+            dispatch(self.router, message)
+            with self.lock:
+                self.dispatched += 1
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        return {
+            "workers": len(self.queues),
+            "queued": sum(depths),
+            "max_depth": max(depths),
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+        }
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+def send_target(frame):
+    # Bans are paced apart from messages to the same group.
+    if isinstance(frame, GroupBan):
+        return ("ban", frame.group)
+    return frame_key(frame)
+
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def delay(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SendQueue():
+    def __init__(self, send, rate=1.0, burst=5, merge=False, merge_limit=1000):
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        # Merge pending texts of the same target and priority into one
+        # message of at most `merge_limit` characters.
+        self.merge = merge
+        self.merge_limit = merge_limit
+
+        self.pending = {}  # target -> heap of (priority, seq, stamp, frame)
+        self.buckets = {}  # target -> TokenBucket
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+
+        self.sent = 0
+        self.merged = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        threaded_sender = threading.Thread(
+            target=self.worker,
+            daemon=True)
+        threaded_sender.start()
+
+    def put(self, frame, priority=None):
+        if priority is None:
+            priority = PRIORITY_HIGH if isinstance(frame, GroupBan) \
+                else PRIORITY_NORMAL
+        item = (priority, next(self.seq), time.monotonic(), frame)
+        with self.cond:
+            heapq.heappush(
+                self.pending.setdefault(send_target(frame), []), item)
+            self.cond.notify()
+
+    def take(self):
+        # Pop the most urgent frame(s) of a target which has a token.
+        while True:
+            now = time.monotonic()
+            best = None
+            wait = None
+            for target, heap in self.pending.items():
+                bucket = self.buckets.get(target)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self.buckets[target] = bucket
+                delay = bucket.delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                elif best is None or heap[0] < self.pending[best][0]:
+                    best = target
+            if best is not None:
+                break
+            self.cond.wait(wait)
+
+        heap = self.pending[best]
+        items = [heapq.heappop(heap)]
+        if self.merge and isinstance(items[0][3], SEND_TEXT_TYPES):
+            size = len(items[0][3].text)
+            while heap and heap[0][0] == items[0][0] and \
+                    type(heap[0][3]) is type(items[0][3]) and \
+                    size + len(heap[0][3].text) < self.merge_limit:
+                size += len(heap[0][3].text) + 2
+                items.append(heapq.heappop(heap))
+        if not heap:
+            del self.pending[best]
+        self.buckets[best].take()
+        return items
+
+    def worker(self):
+        while True:
+            with self.cond:
+                items = self.take()
+            frame = items[0][3]
+            if len(items) > 1:
+                frame = frame._replace(
+                    text='\n\n'.join(str(item[3].text) for item in items))
             try:
-                if (isinstance(message, listener.frame_type) and
-                        listener.handler(message)):
-                    break
+                self.send(frame)
             except:
                 traceback.print_exc()
 
+            now = time.monotonic()
+            with self.cond:
+                self.sent += 1
+                self.merged += len(items) - 1
+                for item in items:
+                    latency = now - item[2]
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        with self.cond:
+            queued = sum(map(len, self.pending.values()))
+            count = self.sent + self.merged
+            return {
+                "queued": queued,
+                "sent": self.sent,
+                "merged": self.merged,
+                "latency_avg": self.latency_total / count if count else 0,
+                "latency_max": self.latency_max,
+            }
+
+
+class APIRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        message = parse_frame(self.request[0])
+        if message is None:
+            return
+        if self.server.dispatcher is not None:
+            self.server.dispatcher.submit(message)
+        else:
+            dispatch(self.server.router, message)
+
 
 class APIServer(socketserver.UDPServer):
-    listeners = []
+    router = Router()
+    dispatcher = None
+
+
+# Listeners, commands and the send path shared by CQBot and AsyncCQBot.
+# Subclasses implement `sendto`, which sends one frame right away.
+class BaseBot():
+    def __init__(self, send_rate=None, send_burst=5, send_merge=False):
+        self.router = Router()
+        self.admins = set()
+        self.commands = None
+
+        # Send Queue
+        #   None: Send messages immediately.
+        #   N: Send at most N messages per second to each group/discuss/qq
+        #      after a burst of `send_burst`, most urgent priority first.
+        #      `send_merge` joins pending texts to the same target.
+        self.send_queue = None
+        if send_rate is not None:
+            self.send_queue = SendQueue(
+                self.sendto, send_rate, send_burst, send_merge)
+
+    def listener(self, frame_type, group=None, qq=None,
+                 exclude_group=None, exclude_qq=None):
+        def decorator(handler):
+            self.router.add(FrameListener(
+                handler, frame_type, group=group, qq=qq,
+                exclude_group=exclude_group, exclude_qq=exclude_qq))
+            return handler
+        return decorator
 
+    def command(self, name, frame_type=RCVD_TEXT_TYPES, admin=False):
+        # handler(message, args); `admin` commands answer `self.admins`.
+        def decorator(handler):
+            if self.commands is None:
+                self.commands = CommandTable(self.admins)
+                self.router.add(FrameListener(self.commands, RCVD_TEXT_TYPES))
+            self.commands.add(name, handler, frame_type, admin)
+            return handler
+        return decorator
 
-class CQBot():
-    def __init__(self, server_port, client_port=0, online=True, debug=False):
-        self.listeners = []
+    def send(self, message, priority=None):
+        if self.send_queue is not None and send_target(message) is not None:
+            self.send_queue.put(message, priority)
+        else:
+            self.sendto(message)
+
+    def broadcast(self, text, groups=(), qqs=(), discusses=(),
+                  priority=None):
+        text = EncodedText(text)
+        for group in groups:
+            self.send(SendGroupMessage(group=group, text=text), priority)
+        for qq in qqs:
+            self.send(SendPrivateMessage(qq=qq, text=text), priority)
+        for discuss in discusses:
+            self.send(SendDiscussMessage(discuss=discuss, text=text),
+                      priority)
+
+    def stats(self):
+        # Counters of the queues in use, to size workers and send rates.
+        stats = {}
+        if self.send_queue is not None:
+            stats["send_queue"] = self.send_queue.stats()
+        return stats
+
+    def report(self):
+        for (name, stats) in sorted(self.stats().items()):
+            print("[QQBot]", "{:10}".format(name), " ".join(
+                "{} {}".format(key, round(value, 3))
+                for (key, value) in stats.items()))
+
+
+class CQBot(BaseBot):
+    def __init__(self, server_port, client_port=0, online=True, debug=False,
+                 workers=0, queue_size=1000,
+                 send_rate=None, send_burst=5, send_merge=False):
+        super().__init__(send_rate, send_burst, send_merge)
 
         self.remote_addr = ("127.0.0.1", server_port)
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -160,16 +789,30 @@ class CQBot():
         #   True: print message instead of sending.
         self.debug = debug
 
+        # Dispatch Mode
+        #   0: Call listeners on the server thread.
+        #   N: Call listeners on N worker threads. Frames of the same
+        #      group/discuss/qq are kept in order. At most `queue_size`
+        #      frames wait per worker, later frames are dropped.
+        self.dispatcher = None
+        if workers > 0:
+            self.dispatcher = Dispatcher(self.router, workers, queue_size)
+
     def __del__(self):
         self.client.close()
         self.server.shutdown()
         self.server.server_close()
 
     def start(self):
+        if self.send_queue is not None:
+            self.send_queue.start()
         if not self.online:
             return
 
-        self.server.listeners = self.listeners
+        self.server.router = self.router
+        if self.dispatcher is not None:
+            self.server.dispatcher = self.dispatcher
+            self.dispatcher.start()
         threaded_server = threading.Thread(
             target=self.server.serve_forever,
             daemon=True)
@@ -186,17 +829,140 @@ class CQBot():
             self.send(ClientHello(port))
             time.sleep(30)
 
-    def listener(self, frame_type):
+    def stats(self):
+        stats = super().stats()
+        if self.dispatcher is not None:
+            stats["dispatcher"] = self.dispatcher.stats()
+        return stats
+
+    def sendto(self, message):
+        if self.debug:
+            print(message)
+            return
+        data = dump_frame(message).encode()
+        self.client.sendto(data, self.remote_addr)
+
+
+class APIProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bot):
+        self.bot = bot
+
+    def datagram_received(self, data, addr):
+        if not self.bot.online:
+            return
+        message = parse_frame(data)
+        if message is None:
+            return
+        self.bot.loop.create_task(self.bot.dispatch(message))
+
+
+class ScheduledJob():
+    def __init__(self, handler, interval, offset):
+        self.handler = handler
+        self.interval = interval
+        self.offset = offset
+
+
+# CQBot running receive, keepalive and jobs on a single asyncio event loop.
+# Listeners and jobs may be plain functions or `async def` coroutines.
+# Plain jobs run in the loop's default executor so that blocking I/O
+# (HTTP polling, file writes) does not stall receiving. `send` may be
+# called from any thread, frames are written on the loop's thread.
+class AsyncCQBot(BaseBot):
+    def __init__(self, server_port, client_port=0, online=True, debug=False,
+                 loop=None, send_rate=None, send_burst=5, send_merge=False):
+        super().__init__(send_rate, send_burst, send_merge)
+        self.jobs = []
+
+        self.remote_addr = ("127.0.0.1", server_port)
+        self.local_addr = ("127.0.0.1", client_port)
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        self.loop = loop
+        self.thread = None  # ident of the thread running `loop`
+        self.transport = None
+        self.unsent = []  # frames sent before the transport exists
+
+        self.online = online
+        self.debug = debug
+
+    def __del__(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def start(self):
+        self.thread = threading.get_ident()
+        if self.send_queue is not None:
+            self.send_queue.start()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: APIProtocol(self),
+            local_addr=self.local_addr)
+        (unsent, self.unsent) = (self.unsent, [])
+        for data in unsent:
+            self.write(data)
+        if self.online:
+            self.loop.create_task(self.server_keepalive())
+        for job in self.jobs:
+            self.loop.create_task(self.run_job(job))
+
+    def run(self):
+        self.loop.run_until_complete(self.start())
+        self.loop.run_forever()
+
+    async def server_keepalive(self):
+        while True:
+            host, port = self.transport.get_extra_info('sockname')[:2]
+            self.send(ClientHello(port))
+            await asyncio.sleep(30)
+
+    async def run_job(self, job):
+        while True:
+            # Align to wall clock like a cron job, e.g. every minute at :10
+            delay = job.interval - (time.time() - job.offset) % job.interval
+            await asyncio.sleep(delay)
+            try:
+                if asyncio.iscoroutinefunction(job.handler):
+                    await job.handler()
+                else:
+                    await self.loop.run_in_executor(None, job.handler)
+            except:
+                traceback.print_exc()
+
+    async def dispatch(self, message):
+        for listener in self.router.route(message):
+            try:
+                result = listener.handler(message)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                if result:
+                    break
+            except:
+                traceback.print_exc()
+
+    def job(self, interval=60, offset=0):
         def decorator(handler):
-            self.listeners.append(FrameListener(handler, frame_type))
+            self.jobs.append(ScheduledJob(handler, interval, offset))
+            return handler
         return decorator
 
-    def send(self, message):
+    def sendto(self, message):
         if self.debug:
             print(message)
             return
         data = dump_frame(message).encode()
-        self.client.sendto(data, self.remote_addr)
+        # Transports are not thread-safe, plain jobs and the send queue
+        # run on other threads.
+        if threading.get_ident() == self.thread:
+            self.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.write, data)
+
+    def write(self, data):
+        if self.transport is None:
+            self.unsent.append(data)
+        else:
+            self.transport.sendto(data, self.remote_addr)
 
 
 if __name__ == '__main__':
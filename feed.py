@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import copy
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import wait
+from datetime import datetime, timezone, timedelta
+
+import utils
+from cqsdk import CQImage, PRIORITY_LOW
+from utils import CQ_IMAGE_ROOT, TTLCache, error, downloader
+
+
+IMAGE_SUBDIR = 'twitter'
+RE_HTML_TAG = re.compile(r'<\w+.*?>|</\w+>')
+RE_AVATAR = re.compile(r'_normal\.(jpg|png|gif)')
+
+utils.mkdir(os.path.join(CQ_IMAGE_ROOT, IMAGE_SUBDIR))
+
+
+################
+# Items
+################
+class Media:
+    def __init__(self, url, requests_kwargs={}):
+        self.url = url
+        self.file = os.path.join(IMAGE_SUBDIR, os.path.basename(url))
+        self.path = os.path.join(CQ_IMAGE_ROOT, self.file)
+        self.requests_kwargs = requests_kwargs
+        self.future = None
+
+    def __getstate__(self):
+        # Futures do not pickle; the file is checked again when needed.
+        state = dict(self.__dict__)
+        state['future'] = None
+        return state
+
+    def __str__(self):
+        return str(CQImage(self.file))
+
+
+class Tweet:
+    # `type_` selects the NOTIFY entries. A `silent` tweet only updates
+    # the dedupe state, e.g. on the first poll of a timeline.
+    def __init__(self, id_, type_):
+        self.id_ = id_
+        self.type_ = type_
+        self.user = None
+        self.date = None
+        self.ja = ''
+        self.zh = ''
+        self.media = []
+        self.silent = False
+
+    def render(self, media):
+        if self.user is None or self.date is None:
+            error("Stringify `Tweet` without `user` or `date`.")
+            raise ValueError()
+        dt = self.date.astimezone(timezone(timedelta(hours=9)))
+        ds = datetime.strftime(dt, "%Y-%m-%d %H:%M:%S JST")
+        results = [self.user, ds]
+        for t in [self.ja, self.zh]:
+            if len(t) == 0:
+                continue
+            t = t.replace('#艦これ', '')
+            t = t.replace('#千年戦争アイギス', '')
+            results.extend(['', t.strip()])
+        results.extend([str(m) for m in media])
+        return '\n'.join(results)
+
+    def __str__(self):
+        return self.render(self.media)
+
+
+class AvatarChange:
+    def __init__(self, type_, user, media):
+        self.type_ = type_
+        self.user = user
+        self.media = [media]
+
+    def render(self, media):
+        return '\n'.join([self.user, "【アイコン変更】"] +
+                         [str(m) for m in media])
+
+
+class Notification:
+    def __init__(self, type_, text):
+        self.type_ = type_
+        self.text = text
+
+
+def parse_twitter(post, requests_kwargs={}):
+    text = post['text']
+    if len(text) == 0:
+        return None
+    tweet = Tweet(post['id_str'], post['user']['screen_name'])
+    tweet.user = post['user']['name']
+    tweet.date = datetime.strptime(
+        post['created_at'], "%a %b %d %H:%M:%S %z %Y")
+    for ent in post['entities'].get('urls', []):
+        text = text.replace(ent['url'], ent['expanded_url'])
+    for ent in post['entities'].get('media', []):
+        text = text.replace(ent['url'], ent['expanded_url'])
+        tweet.media.append(Media(ent['media_url'], requests_kwargs))
+    tweet.ja = text
+    return tweet
+
+
+def parse_kcwiki(post):
+    text = post['zh']
+    if len(text) == 0:
+        return None
+    tweet = Tweet(post['id'], 'KanColle_STAFF')
+    tweet.zh = RE_HTML_TAG.sub('', text)
+    # Dont post old translation.
+    date = datetime.strptime(post['date'], "%Y-%m-%d %H:%M:%S") \
+                   .replace(tzinfo=timezone(timedelta(hours=8)))
+    now = datetime.utcnow() \
+                  .replace(tzinfo=timezone(timedelta(hours=0)))
+    tweet.silent = now - date > timedelta(hours=2)
+    return tweet
+
+
+class AvatarWatch:
+    # Compares the profile image of `screen_name` against the last seen.
+    def __init__(self, screen_name, type_, requests_kwargs={}):
+        self.screen_name = screen_name
+        self.type_ = type_
+        self.requests_kwargs = requests_kwargs
+        self.lock = threading.Lock()
+        self.latest = None
+        self.checked = 0
+
+    def check(self, user):
+        if user['screen_name'] != self.screen_name:
+            return None
+        url = RE_AVATAR.sub(r'.\1', user['profile_image_url_https'])
+        with self.lock:
+            self.checked = time.time()
+            (latest, self.latest) = (self.latest, url)
+        if latest is None:
+            print("[Avatar]", url)
+        if latest is None or latest == url:
+            return None
+        print("[Avatar]", url)
+        return AvatarChange(
+            self.type_, user['name'], Media(url, self.requests_kwargs))
+
+
+################
+# Pipeline
+################
+class Stage:
+    # `workers` threads apply `func` to items from a bounded queue and
+    # hand non-None results to the next stage, blocking while it is full.
+    def __init__(self, name, func, workers=1, maxsize=100):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.next = None
+        self.lock = threading.Lock()
+        self.passed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            start = time.perf_counter()
+            result = None
+            try:
+                result = self.func(item)
+            except:
+                error("[Feed]", self.name, "failed")
+                traceback.print_exc()
+                with self.lock:
+                    self.errors += 1
+            busy = time.perf_counter() - start
+            with self.lock:
+                self.busy += busy
+                if result is not None:
+                    self.passed += 1
+                else:
+                    self.dropped += 1
+            if result is not None and self.next is not None:
+                self.next.put(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'stage': self.name,
+                'queued': self.queue.qsize(),
+                'passed': self.passed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'busy': round(self.busy, 3),
+            }
+
+
+class Feed:
+    # source -> dedupe -> prefetch -> render -> fanout
+    # Media downloads start in `prefetch` and are waited for in `render`,
+    # which has several workers, so a slow image only holds back its own
+    # tweet. After `media_timeout` the text goes out without the image,
+    # which follows in a separate message once downloaded.
+    def __init__(self, qqbot, notify, tweets=None, render_workers=4,
+                 media_timeout=30, maxsize=100):
+        self.qqbot = qqbot
+        self.notify = notify
+        if tweets is None:
+            tweets = TTLCache(1000, 24 * 60 * 60)
+        self.tweets = tweets
+        self.lock = threading.Lock()
+        self.media_timeout = media_timeout
+        self.stages = [
+            Stage('dedupe', self.dedupe, maxsize=maxsize),
+            Stage('prefetch', self.prefetch, maxsize=maxsize),
+            Stage('render', self.render, render_workers, maxsize),
+            Stage('fanout', self.fanout, maxsize=maxsize),
+        ]
+        for (stage, next_) in zip(self.stages, self.stages[1:]):
+            stage.next = next_
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def report(self):
+        for s in self.stats():
+            print("[Feed]", "{stage:8} queued {queued:4} passed {passed:6} "
+                  "dropped {dropped:6} errors {errors:4} busy {busy}s"
+                  .format(**s))
+
+    def dedupe(self, item):
+        # Japanese text comes from Twitter, translations from kcwiki;
+        # both are merged into the cached tweet of the same id.
+        if not isinstance(item, Tweet):
+            return item
+        with self.lock:
+            tweet = self.tweets.setdefault(item.id_, item)
+            if tweet is not item:
+                fresh = False
+                if item.ja and not tweet.ja:
+                    tweet.type_ = item.type_
+                    tweet.user = item.user
+                    tweet.date = item.date
+                    tweet.ja = item.ja
+                    tweet.media = item.media
+                    fresh = True
+                if item.zh and not tweet.zh:
+                    tweet.zh = item.zh
+                    fresh = True
+                if not fresh:
+                    return None
+            if item.silent or tweet.user is None:
+                return None
+            # Later merges must not change what is being rendered.
+            return copy.copy(tweet)
+
+    def prefetch(self, item):
+        for media in item.media:
+            if media.future is None:
+                media.future = downloader.download(
+                    url=media.url,
+                    path=media.path,
+                    requests_kwargs=media.requests_kwargs,
+                )
+        return item
+
+    def render(self, item):
+        # Images must exist before CoolQ sends the message.
+        futures = [media.future for media in item.media]
+        wait(futures, timeout=self.media_timeout)
+        ready = []
+        for media in item.media:
+            if not media.future.done():
+                media.future.add_done_callback(
+                    lambda f, m=media: self.follow_up(item.type_, m, f))
+            elif media.future.exception() is None:
+                ready.append(media)
+        return Notification(item.type_, item.render(ready))
+
+    def follow_up(self, type_, media, future):
+        if future.exception() is None:
+            self.stages[-1].put(Notification(type_, str(media)))
+
+    def fanout(self, item):
+        qqs = []
+        groups = []
+        for notify in self.notify:
+            if item.type_ not in notify.get('type'):
+                continue
+            qqs.extend(notify.get('qq', []))
+            groups.extend(notify.get('group', []))
+        self.qqbot.broadcast(item.text, groups=groups, qqs=qqs,
+                             priority=PRIORITY_LOW)
+        return item
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from utils import error, mkdir
+
+
+def read_cqimg(path):
+    # `.cqimg` files are a single [image] section of key=value lines.
+    info = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            (key, sep, value) = line.partition('=')
+            if sep:
+                info[key.strip()] = value.strip()
+    return info
+
+
+class ImageStore:
+    # Content-addressed image store under the CoolQ image directory.
+    # Blobs are stored once as `.store/<h[:2]>/<hash>`, and the filenames
+    # CoolQ uses are hardlinks to them. When blobs exceed `quota` bytes,
+    # the least recently used ones are evicted together with their aliases.
+    def __init__(self, root, quota=1024 * 1024 * 1024):
+        self.root = root
+        self.quota = quota
+        self.path = os.path.join(root, '.store')
+        mkdir(self.path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(self.path, 'index.db'),
+            check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # REPLACE fires the delete trigger only with recursive triggers.
+        self.db.execute("PRAGMA recursive_triggers=ON")
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY, size INTEGER, atime REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS aliases (
+            name TEXT PRIMARY KEY, hash TEXT, url TEXT)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS blobs_atime
+            ON blobs (atime)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS aliases_url
+            ON aliases (url)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS aliases_hash
+            ON aliases (hash)""")
+        # Running SUM(size) of blobs, kept by triggers since every bot
+        # process writes the same database.
+        self.db.execute("""CREATE TABLE IF NOT EXISTS total (
+            id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)""")
+        self.db.execute("""INSERT OR IGNORE INTO total
+            SELECT 0, COALESCE(SUM(size), 0) FROM blobs""")
+        self.db.execute("""CREATE TRIGGER IF NOT EXISTS blobs_insert
+            AFTER INSERT ON blobs BEGIN
+            UPDATE total SET size = size + NEW.size; END""")
+        self.db.execute("""CREATE TRIGGER IF NOT EXISTS blobs_delete
+            AFTER DELETE ON blobs BEGIN
+            UPDATE total SET size = size - OLD.size; END""")
+        self.db.execute("""CREATE TRIGGER IF NOT EXISTS blobs_update
+            AFTER UPDATE OF size ON blobs BEGIN
+            UPDATE total SET size = size - OLD.size + NEW.size; END""")
+        self.db.execute("COMMIT")
+        self.deduped = 0
+        self.evicted = 0
+
+    def blob_path(self, hash_):
+        return os.path.join(self.path, hash_[:2], hash_)
+
+    def alias_name(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def link(self, hash_, path):
+        # Point `path` at the blob, atomically replacing what is there.
+        mkdir(os.path.dirname(path))
+        tmp_path = path + '.link'
+        try:
+            os.link(self.blob_path(hash_), tmp_path)
+        except OSError:
+            shutil.copyfile(self.blob_path(hash_), tmp_path)
+        os.replace(tmp_path, path)
+
+    def put(self, tmp_path, path, url=None):
+        # Move a downloaded file into the store and alias it as `path`.
+        sha1 = hashlib.sha1()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha1.update(chunk)
+        hash_ = sha1.hexdigest()
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            blob = self.blob_path(hash_)
+            if os.path.exists(blob):
+                os.remove(tmp_path)
+                self.deduped += 1
+            else:
+                mkdir(os.path.dirname(blob))
+                os.replace(tmp_path, blob)
+            self.link(hash_, path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                (hash_, size, time.time()))
+            self.db.execute(
+                "INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)",
+                (self.alias_name(path), hash_, url))
+            self.evict()
+        return hash_
+
+    def link_url(self, url, path):
+        # Alias an already stored download of `url`, without fetching.
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash FROM aliases WHERE url = ? LIMIT 1",
+                (url, )).fetchone()
+            if row is None or not os.path.exists(self.blob_path(row[0])):
+                return False
+            self.link(row[0], path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)",
+                (self.alias_name(path), row[0], url))
+            self.db.execute(
+                "UPDATE blobs SET atime = ? WHERE hash = ?",
+                (time.time(), row[0]))
+            self.deduped += 1
+        return True
+
+    def touch(self, path):
+        with self.lock:
+            self.db.execute(
+                """UPDATE blobs SET atime = ? WHERE hash =
+                (SELECT hash FROM aliases WHERE name = ?)""",
+                (time.time(), self.alias_name(path)))
+
+    def url(self, path):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT url FROM aliases WHERE name = ?",
+                (self.alias_name(path), )).fetchone()
+        return row[0] if row else None
+
+    def cqimg_url(self, path):
+        # URL of a CoolQ image, from the index or its `.cqimg` file.
+        url = self.url(path)
+        if url is None:
+            url = read_cqimg(path + '.cqimg').get('url')
+        return url
+
+    def total(self):
+        (total, ) = self.db.execute(
+            "SELECT size FROM total WHERE id = 0").fetchone()
+        return total
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # e.g. CoolQ has the file open on Windows
+            error("[ImageStore]", "Cannot remove", path)
+            return False
+        return True
+
+    def evict(self):
+        total = self.total()
+        if total <= self.quota:
+            return
+        rows = self.db.execute(
+            "SELECT hash, size FROM blobs ORDER BY atime").fetchall()
+        for (hash_, size) in rows:
+            if total <= self.quota:
+                break
+            # Rows of files that cannot be removed are kept, so they still
+            # count against the quota and are tried again next time.
+            aliases = self.db.execute(
+                "SELECT name FROM aliases WHERE hash = ?",
+                (hash_, )).fetchall()
+            kept = False
+            for (name, ) in aliases:
+                if self.remove(os.path.join(self.root, name)):
+                    self.db.execute(
+                        "DELETE FROM aliases WHERE name = ?", (name, ))
+                else:
+                    kept = True
+            if kept or not self.remove(self.blob_path(hash_)):
+                continue
+            self.db.execute("DELETE FROM blobs WHERE hash = ?", (hash_, ))
+            total -= size
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            (blobs, ) = self.db.execute(
+                "SELECT COUNT(*) FROM blobs").fetchone()
+            size = self.total()
+            (aliases, ) = self.db.execute(
+                "SELECT COUNT(*) FROM aliases").fetchone()
+        return {
+            "blobs": blobs,
+            "bytes": size,
+            "quota": self.quota,
+            "aliases": aliases,
+            "deduped": self.deduped,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import re
+import unicodedata
+from collections import deque
+from itertools import chain
+
+
+# Traditional -> simplified characters, as space separated pairs.
+TRADITIONAL_PAIRS = (
+    "們们 個个 這这 來来 為为 國国 說说 時时 會会 學学 "
+    "對对 開开 關关 過过 還还 發发 髮发 後后 見见 長长 "
+    "電电 問问 無无 東东 車车 門门 馬马 樣样 讓让 點点 "
+    "體体 從从 當当 應应 頭头 經经 實实 現现 機机 種种 "
+    "與与 動动 萬万 進进 裡里 裏里 麼么 買买 賣卖 強强 "
+    "姦奸 腦脑 殘残 氣气 愛爱 號号 雜杂 亂乱 罵骂 蟲虫 "
+    "屍尸 殺杀 錢钱 總总 網网 頁页 線线 話话 語语 認认 "
+    "識识 讀读 寫写 聽听 歡欢 戰战 艦舰 隊队 載载 傳传 "
+    "圖图 務务 備备 裝装 戲戏 遊游 邊边 邏逻 輯辑 計计 "
+    "設设 證证 鐘钟 錯错 鍵键 壓压 屬属 變变 藝艺 豬猪 "
+    "貓猫 鳥鸟 魚鱼 龍龙 龜龟 齊齐 齒齿 黨党 團团 專专 "
+    "導导 彈弹 樂乐 報报 場场 壞坏 處处 夢梦 親亲 覺觉 "
+    "視视 觀观 規规 顯显 類类 題题 願愿 風风 飛飞 餓饿 "
+    "飯饭 養养 驗验 騙骗 鬥斗 鬧闹 媽妈 嗎吗 貝贝 負负 "
+    "費费 資资 賽赛 質质 贏赢 輸输 轉转 辦办 達达 運运 "
+    "選选 遠远 適适 郵邮 醫医 針针 銀银 鐵铁 陽阳 陰阴 "
+    "隨随 難难 雙双 雲云 靈灵 須须 順顺 預预 領领 頻频 "
+    "顏颜 館馆 驚惊 麗丽 黃黄 筆笔 節节 範范 簡简 紅红 "
+    "級级 紀纪 約约 紙纸 組组 結结 給给 統统 絕绝 維维 "
+    "綠绿 緊紧 練练 續续 蘭兰 虛虚 補补 製制 複复 觸触 "
+    "詞词 試试 詳详 誰谁 調调 請请 論论 謝谢 護护 讚赞 "
+    "豐丰 貴贵 幣币 幫帮 廣广 廠厂 張张 彎弯 憂忧 懷怀 "
+    "戶户 擇择 擊击 據据 擔担 擁拥 換换 揚扬 損损 搶抢 "
+    "攝摄 敗败 敵敌 數数 斷断 曉晓 書书 條条 極极 構构 "
+    "槍枪 標标 樹树 橋桥 檢检 歲岁 歷历 歸归 殼壳 決决 "
+    "沒没 況况 減减 測测 湯汤 滅灭 滿满 漢汉 潔洁 濕湿 "
+    "灣湾 災灾 烏乌 熱热 燈灯 爭争 爺爷 牆墙 狀状 猶犹 "
+    "獎奖 獨独 獲获 環环 產产 畫画 異异 療疗 盡尽 監监 "
+    "盤盘 眾众 確确 礙碍 祕秘 禮礼 稅税 稱称 穩稳 窮穷 "
+    "競竞 糧粮 糾纠 紹绍 終终 綱纲 緒绪 編编 緣缘 縣县 "
+    "績绩 織织 繩绳 繪绘 繼继 罰罚 義义 習习 聖圣 聞闻 "
+    "聯联 聲声 職职 肅肃 脫脱 腳脚 膽胆 臉脸 臨临 舊旧 "
+    "莊庄 華华 葉叶 蓋盖 蘇苏 藥药 衛卫 衝冲 襪袜 覽览 "
+    "訂订 記记 訊讯 許许 訪访 評评 診诊 詢询 該该 誤误 "
+    "課课 談谈 議议 貨货 販贩 貼贴 貿贸 賀贺 賓宾 賠赔 "
+    "購购 趕赶 跡迹 蹤踪 軍军 軟软 較较 輕轻 農农 連连 "
+    "週周 遲迟 鄉乡 醜丑 釋释 鈴铃 錄录 鎖锁 鏡镜 閃闪 "
+    "閉闭 間间 閱阅 闆板 際际 險险 隱隐 雞鸡 離离 靜静 "
+    "響响 頂顶 項项 頓顿 顧顾 飲饮 餘余 駕驾 騎骑 驅驱 "
+    "髒脏 鳳凤 鳴鸣 鴨鸭 鵝鹅 鹽盐 麥麦 齡龄 癡痴 緩缓 "
+    "刪删 臺台 於于 準准 幹干 噁恶 塊块 壺壶 夠够 奪夺 "
+    "奮奋 婦妇 嬰婴 寵宠 審审 寶宝 將将 尋寻 層层 嶼屿 "
+    "師师 帶带 廳厅 彥彦 徵征 態态 慣惯 憑凭 懶懒 戀恋 "
+    "掃扫 揮挥 搖摇 攤摊 擬拟 敘叙 暈晕 暫暂 曬晒 樓楼 "
+    "歐欧 氫氢 濟济 瀏浏 燒烧 爛烂 獻献 瑪玛 璽玺 瓊琼 "
+    "禪禅 窩窝 筍笋 簽签 糞粪 紛纷 絲丝 綁绑 緬缅 縮缩 "
+    "繫系 罷罢 羅罗 翹翘 聰聪 膚肤 興兴 艷艳 蔥葱 薦荐 "
+    "蘋苹 螢萤 蠻蛮 褲裤 襲袭 訴诉 詐诈 誇夸 誘诱 諧谐 "
+    "謀谋 謎谜 譯译 豎竖 賤贱 賭赌 賴赖 贊赞 躍跃 輪轮 "
+    "辭辞 邁迈 釘钉 鈔钞 鋪铺 鍋锅 鎮镇 鏈链 鑽钻 閒闲 "
+    "陣阵 陸陆 隻只 雖虽 霧雾 韓韩 頸颈 顫颤 颱台 餅饼 "
+    "騷骚 鬍胡 鬱郁 魯鲁 鮮鲜 鯨鲸 鴿鸽 鷹鹰 麵面 黴霉 "
+    "鼕冬 齣出 "
+)
+
+TRADITIONAL = dict(pair for pair in TRADITIONAL_PAIRS.split())
+
+# Unicode categories stripped from the canonical form: punctuation,
+# symbols and other (zero-width, control). Whitespace becomes one space,
+# which is only dropped between CJK characters, so latin words stay apart.
+STRIPPED_CATEGORIES = 'PSZC'
+RE_SPACES = re.compile(r' {2,}')
+RE_CJK_SPACE = re.compile(
+    r'(?<=[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]) '
+    r'(?=[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿])')
+
+
+class NormalizeTable(dict):
+    # Codepoint -> canonical string, computed once per codepoint.
+    def __missing__(self, codepoint):
+        chars = []
+        # Width folding (fullwidth latin, halfwidth kana) and lower case
+        for char in unicodedata.normalize('NFKC', chr(codepoint)).lower():
+            if char.isspace():
+                chars.append(' ')
+                continue
+            if unicodedata.category(char)[0] in STRIPPED_CATEGORIES:
+                continue
+            chars.append(TRADITIONAL.get(char, char))
+        value = ''.join(chars) or None
+        self[codepoint] = value
+        return value
+
+
+NORMALIZE_TABLE = NormalizeTable()
+# Precompute ASCII, fullwidth forms and traditional characters.
+for codepoint in chain(range(0x80), range(0xFF01, 0xFF5F),
+                       map(ord, TRADITIONAL)):
+    NORMALIZE_TABLE.__missing__(codepoint)
+
+
+def normalize(text):
+    # Canonical form for keyword matching, e.g. "Ｒ.Ｂ.Ｑ" -> "rbq",
+    # "傻　逼" -> "傻逼", "Data  Vis" -> "data vis"
+    text = RE_SPACES.sub(' ', text.translate(NORMALIZE_TABLE))
+    return RE_CJK_SPACE.sub('', text).strip()
+
+
+class KeywordMatcher():
+    # Aho-Corasick automaton: find every keyword of every set in one pass.
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+    def add(self, keyword, value):
+        node = 0
+        for char in keyword:
+            next_ = self.goto[node].get(char)
+            if next_ is None:
+                next_ = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.goto[node][char] = next_
+            node = next_
+        if value not in self.output[node]:
+            self.output[node] += (value, )
+
+    def build(self):
+        goto, fail, output = self.goto, self.fail, self.output
+        nodes = deque(goto[0].values())
+        while nodes:
+            node = nodes.popleft()
+            for char, next_ in goto[node].items():
+                nodes.append(next_)
+                f = fail[node]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                fail[next_] = goto[f].get(char, 0) if node else 0
+                output[next_] += output[fail[next_]]
+        return self
+
+    def search(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        hits = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                hits.update(output[node])
+        return hits
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from collections import namedtuple
+
+from utils import error, mkdir
+
+
+LogRecord = namedtuple("LogRecord", ("group", "qq", "time", "text"))
+
+# crc32(text), time, group, qq, len(text), followed by UTF-8 text
+HEADER = struct.Struct('<IIQQI')
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def position(segment, offset):
+    return segment << 32 | offset
+
+
+class MessageLog:
+    # Append-only log split into segment files `<n>.log`. Every sealed
+    # segment has an index file `<n>.idx` of (qq, offset) pairs, so the
+    # per-QQ index is loaded without scanning the log. Records are read
+    # from memory-mapped segments.
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.index = {}  # qq -> array of positions, oldest first
+        self.maps = {}  # segment -> mmap
+        self.lock = threading.Lock()
+        mkdir(path)
+
+        segments = sorted(
+            int(name[:-4]) for name in os.listdir(path)
+            if name.endswith('.log'))
+        for segment in segments[:-1]:
+            if not self.load_index(segment):
+                pairs = array('Q')
+                self.scan(segment, pairs)
+                self.write_index(segment, pairs)
+        self.first = segments[0] if segments else 0
+        self.segment = segments[-1] if segments else 0
+        self.pairs = array('Q')  # (qq, offset) pairs of active segment
+        self.offset = self.scan(self.segment, self.pairs)
+        self.file = open(self.filename(self.segment, '.log'), 'ab')
+
+    def filename(self, segment, ext):
+        return os.path.join(self.path, '{:08d}{}'.format(segment, ext))
+
+    def add_index(self, qq, pos):
+        positions = self.index.get(qq)
+        if positions is None:
+            positions = self.index[qq] = array('Q')
+        positions.append(pos)
+
+    def load_index(self, segment):
+        try:
+            with open(self.filename(segment, '.idx'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if len(data) % 16 != 0:
+            error("[MessageLog]", "Bad index", segment, len(data))
+            return False
+        pairs = array('Q', data)
+        for i in range(0, len(pairs), 2):
+            self.add_index(pairs[i], position(segment, pairs[i + 1]))
+        return True
+
+    def iterate(self, segment, size=None):
+        # Yield (offset, end, group, qq, time, text) of valid records.
+        path = self.filename(segment, '.log')
+        if size is None:
+            size = os.path.getsize(path)
+        if size == 0:
+            return
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with data:
+            offset = 0
+            while offset + HEADER.size <= size:
+                (crc, time, group, qq, length) = \
+                    HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                end = start + length
+                text = data[start:end]
+                if end > size or zlib.crc32(text) != crc:
+                    return
+                yield (offset, end, group, qq, time, text)
+                offset = end
+
+    def scan(self, segment, pairs=None):
+        # Index records of a segment, truncate a torn record at the tail.
+        path = self.filename(segment, '.log')
+        if not os.path.exists(path):
+            return 0
+        offset = 0
+        for (start, offset, group, qq, time, text) in self.iterate(segment):
+            self.add_index(qq, position(segment, start))
+            if pairs is not None:
+                pairs.extend((qq, start))
+        size = os.path.getsize(path)
+        if offset != size:
+            error("[MessageLog]", "Truncate", path, "at", offset)
+            with open(path, 'rb+') as f:
+                f.truncate(offset)
+        return offset
+
+    def write_index(self, segment, pairs):
+        # Written aside and renamed, so an `.idx` file is never torn.
+        path = self.filename(segment, '.idx')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pairs.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def seal(self):
+        self.write_index(self.segment, self.pairs)
+        self.file.close()
+        self.segment += 1
+        self.offset = 0
+        self.pairs = array('Q')
+        self.file = open(self.filename(self.segment, '.log'), 'ab')
+
+    def append(self, group, qq, time, text):
+        data = text.encode('utf-8')
+        header = HEADER.pack(
+            zlib.crc32(data), time, int(group), int(qq), len(data))
+        with self.lock:
+            if self.offset > 0 and \
+                    self.offset + len(header) + len(data) > self.segment_size:
+                self.seal()
+            self.file.write(header + data)
+            self.file.flush()
+            pos = position(self.segment, self.offset)
+            self.add_index(int(qq), pos)
+            self.pairs.extend((int(qq), self.offset))
+            self.offset += len(header) + len(data)
+        return pos
+
+    def view(self, segment, end):
+        view = self.maps.get(segment)
+        if view is None or len(view) < end:
+            with open(self.filename(segment, '.log'), 'rb') as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            old = self.maps.get(segment)
+            self.maps[segment] = view
+            if old is not None:
+                old.close()
+        return view
+
+    def read(self, pos):
+        (segment, offset) = (pos >> 32, pos & 0xFFFFFFFF)
+        with self.lock:
+            view = self.view(segment, offset + HEADER.size)
+            (crc, time, group, qq, length) = HEADER.unpack_from(view, offset)
+            start = offset + HEADER.size
+            view = self.view(segment, start + length)
+            text = view[start:start + length].decode('utf-8')
+        return LogRecord(str(group), str(qq), time, text)
+
+    def segment_records(self, segment, size=None):
+        # Records of a segment in append order, as (position, LogRecord)
+        for (offset, end, group, qq, time, text) in \
+                self.iterate(segment, size):
+            yield (position(segment, offset), LogRecord(
+                str(group), str(qq), time, text.decode('utf-8')))
+
+    def recent(self, qq, i):
+        # i-th most recent record of qq
+        positions = self.index.get(int(qq), ())
+        if not 0 <= i < len(positions):
+            raise IndexError(i)
+        return self.read(positions[-1 - i])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            for view in self.maps.values():
+                view.close()
+            self.maps = {}
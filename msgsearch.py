@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+from cqsdk import parse_cq
+from utils import dump_pickle, load_pickle, error
+
+
+# Runs of CJK characters (incl. kana, hangul) and of latin words/digits
+RE_CJK = re.compile(
+    r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+RE_WORD = re.compile(r'[0-9a-z]+')
+# Bumped whenever tokenize() changes, saved indexes are rebuilt then.
+INDEX_VERSION = 1
+
+
+def plain_text(segments):
+    # Text of a message without its CQ codes, see cqsdk.parse_cq.
+    return ' '.join(
+        segment.text for segment in segments if segment.type == 'text')
+
+
+def tokenize(text, unigrams=False):
+    # CJK runs become character bigrams, latin runs whole words. Indexed
+    # texts also keep every CJK character, so one-character queries match.
+    text = text.lower()
+    tokens = RE_WORD.findall(text)
+    for run in RE_CJK.findall(text):
+        if unigrams or len(run) == 1:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def contains(postings, doc):
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+class SearchIndex:
+    # Inverted index token -> ascending doc ids. A doc id maps to the
+    # message's position in a MessageLog, its qq and time. The part of
+    # every sealed segment is saved next to it as `<n>.sdx`, so only the
+    # active segment is tokenized again on start.
+    def __init__(self, log):
+        self.log = log
+        self.postings = {}
+        self.positions = array('Q')
+        self.qqs = array('Q')
+        self.times = array('I')
+        self.lock = threading.Lock()
+        self.segment = log.segment
+        for segment in range(log.first, log.segment):
+            if not self.load(segment):
+                self.base = len(self.positions)
+                self.scan(segment)
+                self.save(segment, self.snapshot())
+        self.base = len(self.positions)  # first doc of active segment
+        self.scan(log.segment, log.offset)
+
+    def scan(self, segment, size=None):
+        for (pos, record) in self.log.segment_records(segment, size):
+            tokens = set(tokenize(
+                plain_text(parse_cq(record.text)), unigrams=True))
+            self.insert(pos, record.qq, record.time, tokens)
+
+    def load(self, segment):
+        try:
+            data = load_pickle(self.log.filename(segment, '.sdx'))
+        except Exception as e:
+            error("[SearchIndex]", "Load", segment, e)
+            data = None
+        if data is None or data[0] != INDEX_VERSION:
+            return False
+        (_, postings, qqs, times, positions) = data
+        base = len(self.positions)
+        for (token, local) in postings.items():
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = array('I')
+            docs.extend(array('I', (doc + base for doc in local)))
+        self.qqs.extend(qqs)
+        self.times.extend(times)
+        self.positions.extend(positions)
+        return True
+
+    def snapshot(self):
+        # Docs from `self.base` on, with doc ids relative to it.
+        (base, end) = (self.base, len(self.positions))
+        postings = {}
+        for (token, docs) in self.postings.items():
+            i = bisect_left(docs, base)
+            if i < len(docs):
+                postings[token] = array('I', (doc - base for doc in docs[i:]))
+        return (INDEX_VERSION, postings, self.qqs[base:end],
+                self.times[base:end], self.positions[base:end])
+
+    def save(self, segment, data):
+        try:
+            dump_pickle(data, self.log.filename(segment, '.sdx'))
+        except OSError as e:
+            error("[SearchIndex]", "Save", segment, e)
+
+    def append(self, group, qq, time, text, segments=None):
+        # Appends to the log too, so docs stay in log order when several
+        # threads append at once. Pass `segments` if already parsed.
+        if segments is None:
+            segments = parse_cq(text)
+        tokens = set(tokenize(plain_text(segments), unigrams=True))
+        sealed = None
+        with self.lock:
+            pos = self.log.append(group, qq, time, text)
+            if pos >> 32 != self.segment:
+                # The log sealed the previous segment.
+                sealed = (self.segment, self.snapshot())
+                self.segment = pos >> 32
+                self.base = len(self.positions)
+            self.insert(pos, qq, time, tokens)
+        if sealed is not None:
+            self.save(*sealed)
+        return pos
+
+    def insert(self, pos, qq, time, tokens):
+        # Columns first, a doc in postings must always resolve.
+        doc = len(self.positions)
+        self.qqs.append(int(qq))
+        self.times.append(time)
+        self.positions.append(pos)
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array('I')
+            postings.append(doc)
+
+    def search(self, terms, qq=None, since=None, limit=5):
+        # Messages containing every term, newest first.
+        terms = [term.lower() for term in terms]
+        tokens = set()
+        for term in terms:
+            tokens.update(tokenize(term))
+        if not tokens:
+            return []
+        qq = None if qq is None else int(qq)
+
+        results = []
+        with self.lock:
+            lists = sorted((self.postings.get(token, ()) for token in tokens),
+                           key=len)
+            (first, others) = (lists[0], lists[1:])
+            for doc in reversed(first):
+                if since is not None and self.times[doc] < since:
+                    break
+                if qq is not None and self.qqs[doc] != qq:
+                    continue
+                if not all(contains(postings, doc) for postings in others):
+                    continue
+                # Tokens match, check the phrases on the text itself.
+                record = self.log.read(self.positions[doc])
+                text = record.text.lower()
+                if all(term in text for term in terms):
+                    results.append(record)
+                    if len(results) >= limit:
+                        break
+        return results
@@ -1,25 +1,19 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+import asyncio
 import logging
 import os
 import subprocess
 import sys
-import threading
-import time
 from datetime import datetime, timedelta
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from cqsdk import CQBot, \
+from cqsdk import AsyncCQBot, \
     RcvdPrivateMessage, RcvdGroupMessage, SendPrivateMessage
 from utils import CQ_ROOT, reply
 
 
-qqbot = CQBot(11235)
-scheduler = BackgroundScheduler(
-    timezone='Asia/Tokyo',
-    job_defaults={'misfire_grace_time': 60},
-    )
+qqbot = AsyncCQBot(11235)
 
 
 ################
@@ -37,12 +31,11 @@ def update(message):
     ONLINE.last = datetime.now()
 
 
-@qqbot.listener((RcvdPrivateMessage, ))
-def command(message):
-    if message.qq not in ONLINE.ADMIN:
-        return
-    if message.text != "/online":
-        return
+qqbot.admins.update(ONLINE.ADMIN)
+
+
+@qqbot.command("/online", (RcvdPrivateMessage, ), admin=True)
+def command(message, args):
     text = '\n'.join([
         "ONLINE",
         "Last message at {last}.",
@@ -50,46 +43,46 @@ def command(message):
     reply(qqbot, message, text)
 
 
-@scheduler.scheduled_job('cron', minute='*')
-def check():
+@qqbot.job(interval=60)
+async def check():
     now = datetime.now()
     last = ONLINE.last
     if (now - last) < ONLINE.TOLERANCE or ONLINE.notified_last == last:
         return
     ONLINE.notified_last = last
-    Restarter().start()
-
-
-class Restarter(threading.Thread):
-    def run(self):
-        # 1. Send before restart notification
-        text = '\n'.join([
-            "** WARNING **",
-            "No message for {tolerance}. Restarting CoolQ.",
-            "If you don't receive finish message in 2 mintues, "  # No comma
-            "send /online to check or restart manually."
-            ]).format(tolerance=ONLINE.TOLERANCE)
-        for qq in ONLINE.ADMIN:
-            qqbot.send(SendPrivateMessage(qq=qq, text=text))
-        time.sleep(10)
-        # 2.1. Stop CoolQ
-        logging.warning("Stopping CoolQ")
-        os.system("taskkill /F /T /IM CQP.exe")
-        time.sleep(20)
-        # 2.2. Start CoolQ
-        logging.warning("Starting CoolQ")
-        subprocess.Popen([
-            CQ_ROOT + "/CQP.exe",
-            "/account", "1695676191"],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        time.sleep(30)
-        # 3. Send after restart notification
-        text = '\n'.join([
-            "** INFO **",
-            "Restart has finished.",
-            ])
-        for qq in ONLINE.ADMIN:
-            qqbot.send(SendPrivateMessage(qq=qq, text=text))
+    qqbot.loop.create_task(restart())
+
+
+async def restart():
+    # 1. Send before restart notification
+    text = '\n'.join([
+        "** WARNING **",
+        "No message for {tolerance}. Restarting CoolQ.",
+        "If you don't receive finish message in 2 mintues, "  # No comma
+        "send /online to check or restart manually."
+        ]).format(tolerance=ONLINE.TOLERANCE)
+    for qq in ONLINE.ADMIN:
+        qqbot.send(SendPrivateMessage(qq=qq, text=text))
+    await asyncio.sleep(10)
+    # 2.1. Stop CoolQ
+    logging.warning("Stopping CoolQ")
+    await qqbot.loop.run_in_executor(
+        None, os.system, "taskkill /F /T /IM CQP.exe")
+    await asyncio.sleep(20)
+    # 2.2. Start CoolQ
+    logging.warning("Starting CoolQ")
+    subprocess.Popen([
+        CQ_ROOT + "/CQP.exe",
+        "/account", "1695676191"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    await asyncio.sleep(30)
+    # 3. Send after restart notification
+    text = '\n'.join([
+        "** INFO **",
+        "Restart has finished.",
+        ])
+    for qq in ONLINE.ADMIN:
+        qqbot.send(SendPrivateMessage(qq=qq, text=text))
 
 
 ################
@@ -102,10 +95,7 @@ if __name__ == '__main__':
         format="%(asctime)s %(levelname)s %(funcName)s: %(message)s",
         )
     try:
-        qqbot.start()
-        scheduler.start()
         print("Running...")
-        input()
-        print("Stopping...")
+        qqbot.run()
     except KeyboardInterrupt:
-        pass
+        print("Stopping...")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+from PIL import Image
+
+
+def dhash(path, size=8):
+    # Difference hash: compare adjacent pixels of a downscaled grayscale
+    # image. Near-duplicates (rescaled, recompressed) differ in few bits.
+    with Image.open(path) as image:
+        image = image.convert('L').resize((size + 1, size), Image.LANCZOS)
+        pixels = list(image.getdata())
+    hash_ = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            hash_ = hash_ << 1 | (left > right)
+    return hash_
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    # Multi-index hashing: hashes are split into radius + 1 chunks, each
+    # with its own table. Two hashes within `radius` bits agree on at
+    # least one whole chunk, so only those candidates are compared.
+    def __init__(self, radius, bits=64):
+        self.radius = radius
+        self.chunks = []  # (shift, mask)
+        count = radius + 1
+        shift = 0
+        for i in range(count):
+            width = bits // count + (i < bits % count)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for _ in self.chunks]
+        self.values = {}  # hash -> [value]
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, hash_, value):
+        if hash_ not in self.values:
+            self.values[hash_] = []
+            for (shift, mask), table in zip(self.chunks, self.tables):
+                table.setdefault(hash_ >> shift & mask, []).append(hash_)
+        self.values[hash_].append(value)
+
+    def search(self, hash_):
+        # [(distance, value)] of every hash within `radius`
+        candidates = set()
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            candidates.update(table.get(hash_ >> shift & mask, ()))
+        results = []
+        for candidate in candidates:
+            d = distance(hash_, candidate)
+            if d <= self.radius:
+                results.extend((d, value) for value in self.values[candidate])
+        return results
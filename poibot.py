@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+import bisect
 import json
+import os
 import pickle
 import random
 import re
+import sys
+import threading
 import time
-from collections import deque
-from datetime import datetime, timedelta
+import traceback
+from collections import OrderedDict, deque
+from datetime import timedelta
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from cqsdk import CQBot, CQAt, RE_CQ_SPECIAL, RcvdPrivateMessage, \
-    RcvdGroupMessage, SendGroupMessage, GroupMemberIncrease, GroupBan
-from utils import match, reply
+from cqsdk import CQBot, CQAt, QQArg, Segment, RcvdGroupMessage, \
+    SendGroupMessage, GroupMemberIncrease, GroupBan
+from imagestore import ImageStore
+from matcher import KeywordMatcher, normalize
+from phash import HashIndex, dhash
+from utils import CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA, Journal, downloader, \
+    error, reply
 
 
-qqbot = CQBot(11235)
+qqbot = CQBot(11235, send_rate=1)
 scheduler = BackgroundScheduler(
     timezone='Asia/Tokyo',
     job_defaults={'misfire_grace_time': 60},
@@ -34,27 +43,41 @@ UNBAN_PATTERN = re.compile(r'\((\d+)\) *被管理员解除禁言')
 with open('poi.json', 'r', encoding="utf-8") as f:
     data = json.loads(f.read())
     BANNED_WORDS = data.get("banned-words", [])
+    BANNED_IMAGES = data.get("banned-images", [])
     IGNORED_WORDS = data.get("ignored-words", [])
     IGNORED_USERS = data.get("ignored-users", [])
     NOBAN_USERS = data.get("noban-users", [])
 
 with open('admin.json', 'r', encoding="utf-8") as f:
     ADMIN = json.loads(f.read())
+    qqbot.admins.update(ADMIN)
 
 
 class BanRecord:
+    # Records only exist for users who have been banned, and expire
+    # BANNED_RESET_TIME after their last ban.
+    __slots__ = ('count', 'last')
     records = {}
+    dirty = set()  # QQs changed since last persistence
+    # Guards records, dirty and BanBoard, changed by listeners as well as
+    # by the scheduler jobs below.
+    lock = threading.Lock()
 
-    def __init__(self, count=0, last=datetime.utcnow()):
+    def __init__(self, count=0, last=None):
         self.count = count
-        self.last = last
+        self.last = time.time() if last is None else last
 
-    def increase(self):
-        self.count += 1
-        self.last = datetime.now()
+    def __getstate__(self):
+        return (self.count, self.last)
 
-    def decrease(self):
-        self.count -= 1
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before __slots__, `last` was a datetime.
+            state = (state['count'], state['last'].timestamp())
+        (self.count, self.last) = state
+
+    def expired(self, now):
+        return now - self.last > BANNED_RESET_TIME.total_seconds()
 
     @property
     def multiply(self, base=1):
@@ -63,54 +86,245 @@ class BanRecord:
             multiply = 1
         return multiply
 
+    @classmethod
+    def find(cls, qq):
+        record = cls.records.get(qq)
+        if record is None or record.expired(time.time()):
+            return None
+        return record
+
     @classmethod
     def get(cls, qq):
-        if qq not in cls.records:
-            cls.records[qq] = BanRecord()
-        if datetime.utcnow() - cls.records[qq].last > BANNED_RESET_TIME:
-            cls.records[qq] = BanRecord()
-        return cls.records[qq]
+        record = cls.find(qq)
+        if record is None:
+            record = cls.records[qq] = BanRecord()
+        return record
+
+    @classmethod
+    def add(cls, qq, group, delta=1):
+        with cls.lock:
+            record = cls.get(qq)
+            record.count += delta
+            if delta > 0:
+                record.last = time.time()
+            cls.dirty.add(qq)
+            BanBoard.add(group, qq, delta)
+        return record
+
+    @classmethod
+    def sweep(cls):
+        now = time.time()
+        with cls.lock:
+            expired = [qq for qq, record in cls.records.items()
+                       if record.expired(now)]
+            for qq in expired:
+                del cls.records[qq]
+        return len(expired)
+
+    @classmethod
+    def footprint(cls):
+        size = sys.getsizeof(cls.records)
+        for qq, record in list(cls.records.items()):
+            size += sys.getsizeof(qq) + sys.getsizeof(record)
+        return size
+
+
+class RankIndex:
+    # Counts bucketed by positive value, top-n without sorting all counts.
+    def __init__(self):
+        self.counts = {}
+        self.levels = {}
+        self.order = []
+
+    def add(self, qq, delta):
+        count = self.counts.get(qq, 0)
+        if count > 0:
+            level = self.levels[count]
+            level.remove(qq)
+            if not level:
+                del self.levels[count]
+                del self.order[bisect.bisect_left(self.order, count)]
+        count += delta
+        if count > 0:
+            if count not in self.levels:
+                self.levels[count] = set()
+                bisect.insort(self.order, count)
+            self.levels[count].add(qq)
+        if count != 0:
+            self.counts[qq] = count
+        else:
+            self.counts.pop(qq, None)
+
+    def top(self, n):
+        items = []
+        for count in reversed(self.order):
+            for qq in sorted(self.levels[count]):
+                if len(items) >= n:
+                    return items
+                items.append((qq, count))
+        return items
+
+
+class BanBoard:
+    # Sliding window leaderboards per group, and over all groups (None).
+    WINDOWS = {
+        'hour': 3600,
+        'day': 86400,
+        'week': 604800,
+        'reset': BANNED_RESET_TIME.total_seconds(),
+    }
+    DEFAULT_WINDOW = 'reset'
+    boards = {}  # (group, window) -> (events, RankIndex)
+    pending = []  # Events added since last persistence
+
+    @classmethod
+    def board(cls, group, window):
+        board = cls.boards.get((group, window))
+        if board is None:
+            board = cls.boards[(group, window)] = (deque(), RankIndex())
+        return board
+
+    @classmethod
+    def expire(cls, group, window, now):
+        (events, rank) = cls.board(group, window)
+        while events and events[0][0] < now - cls.WINDOWS[window]:
+            (_, _, qq, delta) = events.popleft()
+            rank.add(qq, -delta)
+        return rank
 
     @classmethod
-    def top(cls, n=10):
-        # Refresh records
-        for qq in cls.records.keys():
-            cls.get(qq)
-        items = cls.records.items()
-        # Filter records
-        items = filter(lambda i: i[1].count > 0, items)
-        # Sort records
-        items = sorted(items, key=lambda i: i[1].count, reverse=True)
-        return items[:n]
-
-
-@qqbot.listener((RcvdGroupMessage, GroupMemberIncrease))
+    def add(cls, group, qq, delta):
+        event = (time.time(), group, qq, delta)
+        cls.insert(event)
+        cls.pending.append(event)
+
+    @classmethod
+    def insert(cls, event):
+        (now, group, qq, delta) = event
+        for key in {group, None}:
+            for window in cls.WINDOWS:
+                (events, rank) = cls.board(key, window)
+                events.append(event)
+                rank.add(qq, delta)
+                cls.expire(key, window, now)
+
+    @classmethod
+    def events(cls):
+        # Events of all groups in the longest window
+        window = max(cls.WINDOWS, key=cls.WINDOWS.get)
+        return list(cls.board(None, window)[0])
+
+    @classmethod
+    def top(cls, group=None, window=DEFAULT_WINDOW, n=10):
+        return cls.expire(group, window, time.time()).top(n)
+
+
+@qqbot.listener((RcvdGroupMessage, GroupMemberIncrease),
+                exclude_group=POI_GROUP)
 def restriction(message):
-    if isinstance(message, (GroupMemberIncrease, )):
-        return message.group != POI_GROUP
-    if message.group != POI_GROUP:
-        return True
-    if message.qq in IGNORED_USERS:
-        return True
-    # else
-    return False
+    return True
 
 
+@qqbot.listener((RcvdGroupMessage, ), qq=IGNORED_USERS)
+def ignored(message):
+    return True
+
+
+################
+# Banned images
+# Checked before `words`, which stops the chain on ignored words.
+################
+BANNED_IMAGE_DISTANCE = 6  # bits of 64-bit dhash
+IMAGE_HASH_CACHE = 10000
+
+image_store = ImageStore(CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA)
+downloader.store = image_store
+
+
+class ImageHashes:
+    lock = threading.Lock()
+    cache = OrderedDict()  # filename -> dhash, least recent first
+    banned = HashIndex(BANNED_IMAGE_DISTANCE)
+
+for i, o in enumerate(BANNED_IMAGES):
+    for path in o.get('images', []):
+        try:
+            ImageHashes.banned.add(dhash(path), i)
+        except:
+            error("Cannot hash banned image", path)
+            traceback.print_exc()
+
+
+@qqbot.listener((RcvdGroupMessage, ), exclude_qq=NOBAN_USERS)
+def images(message):
+    if len(ImageHashes.banned) == 0:
+        return
+    for segment in message.segments:
+        if segment.type != 'image':
+            continue
+        filename = segment.data['file']
+        with ImageHashes.lock:
+            hash_ = ImageHashes.cache.get(filename)
+            if hash_ is not None:
+                ImageHashes.cache.move_to_end(filename)
+        if hash_ is not None:
+            check_image(message, hash_)
+            continue
+        # Hash once the image is downloaded, ban asynchronously.
+        try:
+            path = os.path.join(CQ_IMAGE_ROOT, filename)
+            url = None
+            if not os.path.exists(path):
+                url = image_store.cqimg_url(path)
+                if url is None:
+                    continue
+            future = downloader.download(url, path)
+            future.add_done_callback(
+                lambda f, m=message, n=filename: hash_image(m, n, f))
+        except:
+            error(message)
+            traceback.print_exc()
+
+
+def hash_image(message, filename, future):
+    try:
+        hash_ = dhash(future.result())
+    except:
+        error("Cannot hash image", filename)
+        traceback.print_exc()
+        return
+    with ImageHashes.lock:
+        ImageHashes.cache[filename] = hash_
+        while len(ImageHashes.cache) > IMAGE_HASH_CACHE:
+            ImageHashes.cache.popitem(last=False)
+    check_image(message, hash_)
+
+
+def check_image(message, hash_):
+    hits = ImageHashes.banned.search(hash_)
+    if hits:
+        o = BANNED_IMAGES[min(i for (d, i) in hits)]
+        duration = o.get('duration', 1)
+        qqbot.send(GroupBan(message.group, message.qq, duration * 60))
+
+
+################
+# Banned words
+################
 @qqbot.listener((RcvdGroupMessage, ))
 def words(message):
-    lower_text = message.text.lower()
+    hits = scan(message)
     # Ban
     if message.qq not in NOBAN_USERS:
-        record = BanRecord.get(message.qq)
-        for o in BANNED_WORDS:
-            keywords = o.get('keywords', [])
+        banned = [i for (kind, i) in hits if kind == KEYWORD_BANNED]
+        if banned:
+            o = BANNED_WORDS[min(banned)]
             duration = o.get('duration', 1)
-            if match(lower_text, keywords):
-                # duration *= record.multiply
-                qqbot.send(GroupBan(message.group, message.qq, duration * 60))
-                return True
+            # duration *= BanRecord.get(message.qq).multiply
+            qqbot.send(GroupBan(message.group, message.qq, duration * 60))
+            return True
     # Ignore
-    if match(lower_text, IGNORED_WORDS):
+    if (KEYWORD_IGNORED, 0) in hits:
         return True
     # else
     return False
@@ -123,47 +337,44 @@ def banned(message):
     m = BAN_PATTERN.search(message.text)
     if m is not None:
         qq = m.group(1)
-        record = BanRecord.get(qq)
-        record.increase()
+        record = BanRecord.add(qq, message.group)
         print("Banned: QQ {0} x {1}".format(qq, record.count))
 
 
-@qqbot.listener((RcvdGroupMessage, RcvdPrivateMessage, ))
-def bantop(message):
-    if message.qq not in ADMIN:
-        return
-    texts = message.text.split()
-    if not(len(texts) > 0 and texts[0] == '/bantop'):
-        return
-    try:
-        n = int(texts[1])
-    except:
-        n = 3
-    topN = BanRecord.top(n)
+@qqbot.command('/bantop', admin=True)
+def bantop(message, args):
+    # /bantop [n] [hour|day|week|reset]
+    n = 3
+    window = BanBoard.DEFAULT_WINDOW
+    texts = [arg for arg in args if not isinstance(arg, (QQArg, Segment))]
+    for text in texts[:2]:
+        if text in BanBoard.WINDOWS:
+            window = text
+            continue
+        try:
+            n = int(text)
+        except:
+            pass
+    group = getattr(message, 'group', None)
+    with BanRecord.lock:
+        topN = BanBoard.top(group, window, n)
     texts = ["**** 禁言次数排名 ****"]
-    for qq, record in topN:
+    for qq, count in topN:
         texts.append("{qq} {count}".format(
-            qq=CQAt(qq), count=record.count))
+            qq=CQAt(qq), count=count))
     text = '\n'.join(texts)
     reply(qqbot, message, text)
     return True
 
 
-@qqbot.listener((RcvdGroupMessage, RcvdPrivateMessage, ))
-def banset(message):
-    if message.qq not in ADMIN:
-        return
-    texts = message.text.split()
-    if not(len(texts) > 0 and texts[0] == '/banset'):
-        return
+@qqbot.command('/banset', admin=True)
+def banset(message, args):
     try:
-        qq = texts[1]
-        qqm = CQAt.PATTERN.fullmatch(qq)
-        if qqm and qqm.group(1):
-            qq = qqm.group(1)
-        n = int(texts[2])
+        qq = args[0]
+        n = int(args[1])
         record = BanRecord.get(qq)
-        record.count = n
+        record = BanRecord.add(
+            qq, getattr(message, 'group', None), n - record.count)
         reply(qqbot, message, "Set ban count: {qq} {count}".format(
             qq=CQAt(qq), count=record.count))
     except:
@@ -171,19 +382,11 @@ def banset(message):
     return True
 
 
-@qqbot.listener((RcvdGroupMessage, RcvdPrivateMessage, ))
-def banget(message):
-    if message.qq not in ADMIN:
-        return
-    texts = message.text.split()
-    if not(len(texts) > 0 and texts[0] == '/banget'):
-        return
+@qqbot.command('/banget', admin=True)
+def banget(message, args):
     try:
-        qq = texts[1]
-        qqm = CQAt.PATTERN.fullmatch(qq)
-        if qqm and qqm.group(1):
-            qq = qqm.group(1)
-        record = BanRecord.get(qq)
+        qq = args[0]
+        record = BanRecord.find(qq) or BanRecord()
         reply(qqbot, message, "Ban count: {qq} {count}".format(
             qq=CQAt(qq), count=record.count))
     except:
@@ -191,6 +394,13 @@ def banget(message):
     return True
 
 
+@qqbot.command('/banstat', admin=True)
+def banstat(message, args):
+    reply(qqbot, message, "Ban records: {count} ({size} bytes)".format(
+        count=len(BanRecord.records), size=BanRecord.footprint()))
+    return True
+
+
 ################
 # FAQ
 ################
@@ -211,14 +421,52 @@ with open('faq.json', 'r', encoding="utf-8") as f:
         FAQ.append(FAQObject(faq))
 
 
+################
+# Keywords
+################
+KEYWORD_BANNED = 'banned'
+KEYWORD_IGNORED = 'ignored'
+KEYWORD_FAQ = 'faq'
+KEYWORD_FAQ_WHITELIST = 'faq-whitelist'
+
+KEYWORDS = KeywordMatcher()
+
+
+def add_keywords(keywords, value):
+    # Keywords and messages share one canonical form, see `normalize`.
+    for keyword in map(normalize, keywords):
+        if keyword:
+            KEYWORDS.add(keyword, value)
+
+for i, o in enumerate(BANNED_WORDS):
+    add_keywords(o.get('keywords', []), (KEYWORD_BANNED, i))
+add_keywords(IGNORED_WORDS, (KEYWORD_IGNORED, 0))
+for i, o in enumerate(FAQ):
+    add_keywords(o.keywords, (KEYWORD_FAQ, i))
+    add_keywords(o.whitelist, (KEYWORD_FAQ_WHITELIST, i))
+KEYWORDS.build()
+
+
+class Scanned:
+    last = (None, set())
+
+
+def scan(message):
+    # Scan once per message, shared by `words` and `faq`.
+    (last, hits) = Scanned.last
+    if last is not message:
+        hits = KEYWORDS.search(normalize(message.text))
+        Scanned.last = (message, hits)
+    return hits
+
+
 @qqbot.listener((RcvdGroupMessage, ))
 def faq(message):
-    text = message.text.lower()
+    hits = scan(message)
     now = time.time()
-    for faq in FAQ:
-        if not match(text, faq.keywords):
-            continue
-        if match(text, faq.whitelist):
+    for i in sorted(i for (kind, i) in hits if kind == KEYWORD_FAQ):
+        faq = FAQ[i]
+        if (KEYWORD_FAQ_WHITELIST, i) in hits:
             return True
         if (now - faq.triggered) < faq.interval:
             return True
@@ -242,15 +490,12 @@ ROLL_SEPARATOR = ','
 ROLL_HELP = "[roll] 有效范围为 {} ~ {}".format(ROLL_LOWER, ROLL_UPPER)
 
 
-@qqbot.listener((RcvdGroupMessage, ))
-def roll(message):
-    texts = message.text.split()
-    if not (len(texts) > 0 and texts[0] == '/roll'):
-        return
-    texts = RE_CQ_SPECIAL.sub('', message.text).split()
+@qqbot.command('/roll', (RcvdGroupMessage, ))
+def roll(message, args):
+    texts = [arg for arg in args if not isinstance(arg, (QQArg, Segment))]
 
     ranges = []
-    for text in texts[1:6]:
+    for text in texts[:5]:
         # /roll 100
         try:
             n = int(text)
@@ -290,9 +535,9 @@ def roll(message):
 # repeat
 ################
 REPEAT_QUEUE_SIZE = 20
+REPEAT_QUEUE_TIME = timedelta(minutes=30)
 REPEAT_COUNT_MIN = 2
 REPEAT_COUNT_MAX = 4
-queue = deque()
 
 
 class QueueMessage:
@@ -301,6 +546,36 @@ class QueueMessage:
         self.count = 0
         self.senders = set()
         self.repeated = False
+        self.last = 0
+
+
+class RepeatQueue:
+    # Per group LRU of recent texts, newest last.
+    def __init__(self, size, age):
+        self.size = size
+        self.age = age.total_seconds()
+        self.groups = {}
+
+    def get(self, group, text):
+        now = time.time()
+        queue = self.groups.get(group)
+        if queue is None:
+            queue = self.groups[group] = OrderedDict()
+
+        msg = queue.get(text)
+        if msg is None:
+            msg = queue[text] = QueueMessage(text)
+        else:
+            queue.move_to_end(text)
+        msg.last = now
+
+        while len(queue) > self.size:
+            queue.popitem(last=False)
+        while queue and next(iter(queue.values())).last < now - self.age:
+            queue.popitem(last=False)
+        return msg
+
+repeat_queue = RepeatQueue(REPEAT_QUEUE_SIZE, REPEAT_QUEUE_TIME)
 
 
 class RandomQueue:
@@ -321,34 +596,19 @@ rQueue2 = RandomQueue([True, False, False, False, False])
 
 @qqbot.listener((RcvdGroupMessage, ))
 def repeat(message):
-    text = message.text
     sender = message.qq
 
-    # Find & remove matched message from queue.
-    msg = None
-    for m in queue:
-        if m.text == text:
-            msg = m
-            queue.remove(m)
-            break
-
-    # Increase message count
-    if msg is None:
-        msg = QueueMessage(text)
+    # Find or push message to queue, increase message count
+    msg = repeat_queue.get(message.group, message.text)
     msg.senders.add(sender)
     msg.count = len(msg.senders)
 
-    # Push message back to queue
-    queue.appendleft(msg)
-    if len(queue) > REPEAT_QUEUE_SIZE:
-        queue.pop()
-
     # Ban4 event
     if msg.repeated and sender not in NOBAN_USERS and rQueue1.next():
         record = BanRecord.get(sender)
         duration = record.multiply * 1
         qqbot.send(GroupBan(message.group, sender, duration * 60))
-        record.increase()
+        BanRecord.add(sender, message.group)
 
     # Repeat message
     if msg.repeated or msg.count < REPEAT_COUNT_MIN:
@@ -364,8 +624,7 @@ def repeat(message):
 def ban_every(message):
     QQ = []
     if message.qq in QQ and rQueue2.next():
-        # record = BanRecord.get(message.qq)
-        # record.decrease()
+        # BanRecord.add(message.qq, message.group, -1)
         qqbot.send(GroupBan(message.group, message.qq, 1 * 60))
 
 
@@ -393,19 +652,82 @@ def join(message):
 ################
 # Persistence
 ################
-PFILE = './persistence.txt'
+PFILE = './persistence.pickle'
+PFILE_LEGACY = './persistence.txt'
+JOURNAL_LIMIT = 1024 * 1024
+journal = Journal(PFILE)
+
+
+def recover():
+    (state, entries) = journal.load()
+    if state is None:
+        state = {'records': {}, 'events': []}
+        try:
+            with open(PFILE_LEGACY, 'rb') as f:
+                state['records'] = pickle.load(f)
+            # Seed leaderboards, ban groups were not persisted.
+            for qq, record in state['records'].items():
+                state['events'].append(
+                    (record.last, POI_GROUP, qq, record.count))
+            state['events'].sort(key=lambda event: event[0])
+        except FileNotFoundError:
+            pass
+
+    records = state['records']
+    events = state['events']
+    for (kind, *entry) in entries:
+        if kind == 'record':
+            (qq, record) = entry
+            records[qq] = record
+        if kind == 'event':
+            events.append(entry[0])
+
+    BanRecord.records = records
+    for event in events:
+        BanBoard.insert(event)
+    compaction()
+
+
+def compaction():
+    with BanRecord.lock:
+        state = {
+            'records': dict(BanRecord.records),
+            'events': BanBoard.events(),
+        }
+    journal.compact(state)
+
+recover()
+
 
-try:
-    with open(PFILE, 'rb') as f:
-        BanRecord.records = pickle.load(f)
-except FileNotFoundError:
-    pass
+@scheduler.scheduled_job('cron', minute='*', second='30')
+def sweep():
+    expired = BanRecord.sweep()
+    if expired > 0:
+        print("Sweep: {0} expired, {1} records, {2} bytes".format(
+            expired, len(BanRecord.records), BanRecord.footprint()))
 
 
 @scheduler.scheduled_job('cron', minute='*')
 def persistence():
-    with open(PFILE, 'wb') as f:
-        pickle.dump(BanRecord.records, f)
+    # Journal changes only, snapshot when the journal grows too large.
+    entries = []
+    with BanRecord.lock:
+        (dirty, BanRecord.dirty) = (BanRecord.dirty, set())
+        (events, BanBoard.pending) = (BanBoard.pending, [])
+        for qq in dirty:
+            record = BanRecord.records.get(qq)
+            if record is not None:
+                entries.append(('record', qq, record))
+    for event in events:
+        entries.append(('event', event))
+    journal.append(entries)
+    if journal.size() > JOURNAL_LIMIT:
+        compaction()
+
+
+@scheduler.scheduled_job('cron', minute='0')
+def report():
+    qqbot.report()
 
 
 ################
@@ -2,21 +2,23 @@
 # coding: UTF-8
 
 import json
-import os
-import re
+import time
 import traceback
-from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import requests.adapters
 from apscheduler.schedulers.background import BackgroundScheduler
 from requests_oauthlib import OAuth1Session
 
-import utils
-from utils import CQ_IMAGE_ROOT, info, error, FileDownloader
-from cqsdk import CQBot, CQImage, SendGroupMessage, SendPrivateMessage
+from feed import Feed, AvatarWatch, parse_twitter, parse_kcwiki
+from imagestore import ImageStore
+from utils import CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA, TTLCache, error, \
+    downloader, dump_pickle, load_pickle
+from cqsdk import CQBot
 
 
-qqbot = CQBot(11235, online=False)
+qqbot = CQBot(11235, online=False, send_rate=0.5, send_merge=True)
 scheduler = BackgroundScheduler(
     timezone='Asia/Tokyo',
     job_defaults={'misfire_grace_time': 60},
@@ -32,6 +34,13 @@ with open('twitter.json', 'r') as f:
     )
     NOTIFY = data['notify']
 
+TWITTER_USERS = ["KanColle_STAFF", "Aigis1000"]
+adapter = requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=len(TWITTER_USERS))
+session.mount('https://', adapter)
+
+downloader.store = ImageStore(CQ_IMAGE_ROOT, CQ_IMAGE_QUOTA)
+
 REQUESTS_OPTIONS = {
     'timeout': 10,
 }
@@ -46,225 +55,218 @@ REQUESTS_OPTIONS_PROXIED = {
 
 ################
 # Timeline
-# Assume no posting 20+ tweet in a minute.
+# Every account is polled on its own interval: POLL_MIN right after it
+# posted, backing off to POLL_MAX while it stays quiet. Due accounts are
+# polled concurrently, and Twitter is only asked for tweets newer than
+# the last one seen (`since_id`). Tweets are handed to `feed`.
 ################
+POLL_TICK = 5
+POLL_MIN = 15
+POLL_MAX = 60
+POLL_BACKOFF = 1.5
+# Translations arrive within hours, older tweets are only kept for dedupe.
+TWEET_CACHE_SIZE = 1000
+TWEET_CACHE_TTL = 24 * 60 * 60
+PFILE = './twitter.pickle'
+
 TEMPLATE_TWITTER = {
     **REQUESTS_OPTIONS_PROXIED,
     'url': "https://api.twitter.com/1.1/statuses/user_timeline.json",
-    'params': {
-        "screen_name": "KanColle_STAFF",
-        "count": 20,
-    },
 }
 TEMPLATE_KCWIKI = {
+    **REQUESTS_OPTIONS,
     'url': "http://api.kcwiki.moe/tweet/20",
 }
 
+feed = Feed(qqbot, NOTIFY, TTLCache(TWEET_CACHE_SIZE, TWEET_CACHE_TTL))
+
 
 class Twitter:
-    tweets = {}
     inited = {}
-    html_tag = re.compile(r'<\w+.*?>|</\w+>')
-    image_subdir = 'twitter'
-
-utils.mkdir(os.path.join(CQ_IMAGE_ROOT, Twitter.image_subdir))
-
-
-class Tweet:
-    def __init__(self, id_):
-        self.id_ = id_
-        self.user = None
-        self.date = None
-        self.ja = ''
-        self.zh = ''
-        self.media = []
-
-    def __str__(self):
-        if self.user is None or self.date is None:
-            error("Stringify `Tweet` without `user` or `date`.")
-            raise ValueError()
-        dt = self.date.astimezone(timezone(timedelta(hours=9)))
-        ds = datetime.strftime(dt, "%Y-%m-%d %H:%M:%S JST")
-        results = [self.user, ds]
-        for t in [self.ja, self.zh]:
-            if len(t) == 0:
-                continue
-            # Fix GBK encoding
-            t = t.replace('・', '·')
-            t = t.replace('✕', '×')
-            t = t.replace('#艦これ', '')
-            t = t.replace('#千年戦争アイギス', '')
-            results.extend(['', t.strip()])
-        results.extend([str(m) for m in self.media])
-        return '\n'.join(results)
-
-
-@scheduler.scheduled_job('cron', minute='*', second='10')
-def poll_twitter_all():
-    for user in ["KanColle_STAFF", "Aigis1000"]:
-        try:
-            poll_twitter(user)
-        except:
-            traceback.print_exc()
+    since_id = {}
+    interval = {}
+    next_poll = {}
 
 
-def poll_twitter(user):
-    Template = dict(TEMPLATE_TWITTER)
-    Template['params']['screen_name'] = user
+class Kcwiki:
+    # Validators of the last response, so an unchanged feed costs a 304.
+    session = requests.Session()
+    etag = None
+    modified = None
+
 
-    resp = session.get(**Template)
+def poll_twitter(user):
+    params = {"screen_name": user, "count": 20}
+    if user in Twitter.since_id:
+        params['since_id'] = Twitter.since_id[user]
+    resp = session.get(params=params, **TEMPLATE_TWITTER)
     if resp.status_code != 200:
         print(user, "Response not success", resp)
+        return 0
     posts = resp.json()
     posts.reverse()
 
     for post in posts:
-        id_ = post['id_str']
-        text = post['text']
-        tweet = Twitter.tweets.get(id_, Tweet(id_))
-        if len(text) == 0:
-            continue
-        if len(tweet.ja) > 0:
+        tweet = parse_twitter(post, REQUESTS_OPTIONS_PROXIED)
+        if tweet is None:
             continue
+        tweet.silent = not Twitter.inited.get(user)
+        feed.put(tweet)
 
-        tweet.user = post['user']['name']
-        tweet.date = datetime.strptime(
-            post['created_at'], "%a %b %d %H:%M:%S %z %Y")
-        for ent in post['entities'].get('urls', []):
-            text = text.replace(ent['url'], ent['expanded_url'])
-        for ent in post['entities'].get('media', []):
-            text = text.replace(ent['url'], ent['expanded_url'])
-            url = ent['media_url']
-            filename = os.path.basename(url)
-            FileDownloader(
-                url=url,
-                path=os.path.join(
-                    CQ_IMAGE_ROOT, Twitter.image_subdir, filename),
-                requests_kwargs=REQUESTS_OPTIONS_PROXIED,
-            ).run()
-            tweet.media.append(
-                CQImage(os.path.join(Twitter.image_subdir, filename)))
-        tweet.ja = text
-        Twitter.tweets[id_] = tweet
-
-        if Twitter.inited.get(user):
-            text = str(tweet)
-            info(text)
-            for notify in NOTIFY:
-                if user not in notify.get('type'):
-                    continue
-                for q in notify.get('qq', []):
-                    qqbot.send(SendPrivateMessage(qq=q, text=text))
-                for g in notify.get('group', []):
-                    qqbot.send(SendGroupMessage(group=g, text=text))
-
+    if posts:
+        Twitter.since_id[user] = posts[-1]['id_str']
+        # The timeline carries the profile, no need to ask for it.
+        check_avatar(posts[-1]['user'])
     if not Twitter.inited.get(user):
         Twitter.inited[user] = True
         print(user, "init", len(posts))
-
-
-@scheduler.scheduled_job('cron', minute='*', second='30')
-def poll_kcwiki():
-    user = 'kcwiki'
-    resp = requests.get(**TEMPLATE_KCWIKI)
+    return len(posts)
+
+
+def poll_kcwiki(user):
+    headers = {}
+    if Kcwiki.etag is not None:
+        headers['If-None-Match'] = Kcwiki.etag
+    if Kcwiki.modified is not None:
+        headers['If-Modified-Since'] = Kcwiki.modified
+    resp = Kcwiki.session.get(headers=headers, **TEMPLATE_KCWIKI)
+    if resp.status_code == 304:
+        return 0
     if resp.status_code != 200:
         print(user, "Response not success", resp)
-        return
+        return 0
     posts = resp.json()
     posts.reverse()
 
+    # Every response holds the last posts, only recent translations not
+    # seen yet count as activity. Older ones drop out of `feed.tweets`.
+    count = 0
     for post in posts:
-        id_ = post['id']
-        text = post['zh']
-        tweet = Twitter.tweets.get(id_, Tweet(id_))
-        if len(text) == 0:
+        tweet = parse_kcwiki(post)
+        if tweet is None:
             continue
-        if len(tweet.zh) > 0:
+        with feed.lock:
+            seen = feed.tweets.get(tweet.id_)
+        if seen is not None and seen.zh:
             continue
+        if not tweet.silent:
+            count += 1
+        tweet.silent = tweet.silent or not Twitter.inited.get(user)
+        feed.put(tweet)
 
-        text = Twitter.html_tag.sub('', text)
-        tweet.zh = text
-        Twitter.tweets[id_] = tweet
-
-        # Dont post old translation.
-        date = datetime.strptime(post['date'], "%Y-%m-%d %H:%M:%S") \
-                       .replace(tzinfo=timezone(timedelta(hours=8)))
-        now = datetime.utcnow() \
-                      .replace(tzinfo=timezone(timedelta(hours=0)))
-        if now - date > timedelta(hours=2):
-            continue
-
-        if Twitter.inited.get(user):
-            text = str(tweet)
-            info(text)
-            for notify in NOTIFY:
-                if 'KanColle_STAFF' not in notify.get('type'):
-                    continue
-                for q in notify.get('qq', []):
-                    qqbot.send(SendPrivateMessage(qq=q, text=text))
-                for g in notify.get('group', []):
-                    qqbot.send(SendGroupMessage(group=g, text=text))
-
+    Kcwiki.etag = resp.headers.get('ETag')
+    Kcwiki.modified = resp.headers.get('Last-Modified')
     if not Twitter.inited.get(user):
         Twitter.inited[user] = True
         print(user, "init", len(posts))
+    return count
+
+
+POLLERS = {user: poll_twitter for user in TWITTER_USERS}
+POLLERS['kcwiki'] = poll_kcwiki
+executor = ThreadPoolExecutor(max_workers=len(POLLERS))
+
+
+@scheduler.scheduled_job('interval', seconds=POLL_TICK)
+def poll_all():
+    now = time.time()
+    due = [user for user in POLLERS if Twitter.next_poll.get(user, 0) <= now]
+    futures = [executor.submit(POLLERS[user], user) for user in due]
+    dirty = False
+    for (user, future) in zip(due, futures):
+        count = 0
+        inited = Twitter.inited.get(user)
+        try:
+            count = future.result()
+        except:
+            traceback.print_exc()
+        dirty = dirty or count > 0 or inited != Twitter.inited.get(user)
+        interval = Twitter.interval.get(user, POLL_MIN)
+        if count > 0:
+            interval = POLL_MIN
+        else:
+            interval = min(interval * POLL_BACKOFF, POLL_MAX)
+        Twitter.interval[user] = interval
+        Twitter.next_poll[user] = now + interval
+    if dirty:
+        persist()
+
+
+@scheduler.scheduled_job('cron', minute='0')
+def report():
+    feed.report()
+    qqbot.report()
+
+
+################
+# Persistence
+# Dedupe state survives restarts, so the first poll after a restart picks
+# up from `since_id` instead of flooding or skipping.
+################
+def persist():
+    try:
+        with feed.lock:
+            feed.tweets.expire()
+            state = {
+                'tweets': feed.tweets,
+                'inited': dict(Twitter.inited),
+                'since_id': dict(Twitter.since_id),
+                'avatar': avatar.latest,
+            }
+            dump_pickle(state, PFILE)
+    except:
+        error("[Persistence]", "Failed to save", PFILE)
+        traceback.print_exc()
+
+
+def recover():
+    try:
+        state = load_pickle(PFILE)
+    except:
+        error("[Persistence]", "Cannot load", PFILE)
+        traceback.print_exc()
+        return
+    if state is None:
+        return
+    state['tweets'].expire()
+    feed.tweets = state['tweets']
+    Twitter.inited = state['inited']
+    Twitter.since_id = state['since_id']
+    avatar.latest = state['avatar']
+    print("[Persistence]", "Recovered", len(feed.tweets), "tweets")
 
 
 ################
 # avatar
+# Changes are picked up from the timeline payload. users/show is only
+# asked when the timeline has been silent for AVATAR_REFRESH seconds.
 ################
-class Avatar:
-    twitter_url = "https://api.twitter.com/1.1/users/show.json"
-    twitter_params = {"screen_name": "KanColle_STAFF"}
-    image_prog = re.compile(r'_normal\.(jpg|png|gif)')
-    image_repl = r'.\1'
-    image_subdir = 'twitter'
-    latest = None
+AVATAR_URL = "https://api.twitter.com/1.1/users/show.json"
+AVATAR_REFRESH = 600
 
-utils.mkdir(os.path.join(CQ_IMAGE_ROOT, Avatar.image_subdir))
+avatar = AvatarWatch("KanColle_STAFF", '*Avatar', REQUESTS_OPTIONS_PROXIED)
 
 
 @scheduler.scheduled_job('cron', minute='*', second='50')
 def poll_avatar():
+    if time.time() - avatar.checked < AVATAR_REFRESH:
+        return
     resp = session.get(
-        url=Avatar.twitter_url,
-        params=Avatar.twitter_params,
+        url=AVATAR_URL,
+        params={"screen_name": avatar.screen_name},
         **REQUESTS_OPTIONS_PROXIED)
 
     if resp.status_code == 200:
-        user = resp.json()
-        url = Avatar.image_prog.sub(
-            Avatar.image_repl, user['profile_image_url_https'])
+        check_avatar(resp.json())
+        persist()
     else:
         error("[Avatar]", "Response failed:", resp.status_code, resp.text)
-        return
 
-    if Avatar.latest is None:
-        Avatar.latest = url
-        print("[Avatar]", url)
-        return
 
-    if Avatar.latest != url:
-        print("[Avatar]", url)
-        filename = os.path.basename(url)
-        FileDownloader(
-            url=url,
-            path=os.path.join(
-                CQ_IMAGE_ROOT, Avatar.image_subdir, filename),
-            requests_kwargs=REQUESTS_OPTIONS_PROXIED
-        ).run()
-        Avatar.latest = url
-
-        text = '\n'.join([
-            user['name'],
-            "【アイコン変更】",
-            str(CQImage(os.path.join(Avatar.image_subdir, filename)))
-        ])
-        for notify in NOTIFY:
-            if '*Avatar' not in notify.get('type'):
-                continue
-            for g in notify['group']:
-                qqbot.send(SendGroupMessage(group=g, text=text))
+def check_avatar(user):
+    change = avatar.check(user)
+    if change is not None:
+        feed.put(change)
 
 
 ################
@@ -272,6 +274,8 @@ def poll_avatar():
 ################
 if __name__ == '__main__':
     try:
+        recover()
+        feed.start()
         qqbot.start()
         scheduler.start()
         print("Running...")
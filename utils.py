@@ -1,11 +1,16 @@
 #!/use/bin/env python3
 
 import os
+import pickle
 import sys
+import tempfile
 import threading
-import traceback
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import requests.adapters
 from cqsdk import RE_CQ_SPECIAL, \
     RcvdPrivateMessage, RcvdGroupMessage, RcvdDiscussMessage, \
     SendPrivateMessage, SendGroupMessage, SendDiscussMessage, \
@@ -14,6 +19,8 @@ from cqsdk import RE_CQ_SPECIAL, \
 
 CQ_ROOT = r'C:/Users/Administrator/Desktop/CQP'
 CQ_IMAGE_ROOT = os.path.join(CQ_ROOT, r'data/image')
+# Every bot shares the image store under CQ_IMAGE_ROOT, and so its quota.
+CQ_IMAGE_QUOTA = 4 * 1024 * 1024 * 1024
 
 
 def info(*args, **kwargs):
@@ -63,24 +70,203 @@ def reply(qqbot, message, text):
         print("↗", reply_msg)
 
 
-class FileDownloader(threading.Thread):
-    def __init__(self, url, path, requests_kwargs={}, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.url = url
+def dump_pickle(obj, path):
+    # Write to a temporary file and rename, so `path` is never torn.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_pickle(path, default=None):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return default
+
+
+class TTLCache:
+    # Mapping bounded in both size and age. Entries are ordered by the
+    # time they were last written, oldest are evicted first.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (time, value)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None or time.time() - item[0] > self.ttl:
+            return default
+        return item[1]
+
+    def __setitem__(self, key, value):
+        self.data[key] = (time.time(), value)
+        self.data.move_to_end(key)
+        self.expire()
+
+    def setdefault(self, key, default):
+        value = self.get(key, self)
+        if value is self:
+            self[key] = value = default
+        return value
+
+    def expire(self):
+        now = time.time()
+        while self.data:
+            (t, _) = next(iter(self.data.values()))
+            if len(self.data) <= self.maxsize and now - t <= self.ttl:
+                break
+            self.data.popitem(last=False)
+
+
+class Journal:
+    # Snapshot of the whole state plus an append-only journal of changes
+    # since the snapshot. Entries are numbered, so replaying a journal on
+    # a newer snapshot (crash between snapshot and truncate) is harmless.
+    def __init__(self, path):
         self.path = path
-        self.requests_kwargs = requests_kwargs
+        self.journal_path = path + '.journal'
+        self.seq = 0
+        self.file = None
+
+    def load(self):
+        (self.seq, state) = load_pickle(self.path, (0, None))
 
-    def run(self):
+        entries = []
         try:
-            self.download()
-        except:
-            error("[FileDownloader]", "Catch exception on downloading.")
-            traceback.print_exc()
-
-    def download(self):
-        if os.path.exists(self.path):
-            print("[FileDownloader]", "Exists", self.path)
+            with open(self.journal_path, 'rb+') as f:
+                offset = 0
+                while True:
+                    try:
+                        (seq, entry) = pickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception:
+                        # Torn write at the tail, drop it.
+                        error("[Journal]", "Truncate", self.journal_path,
+                              "at", offset)
+                        f.truncate(offset)
+                        break
+                    offset = f.tell()
+                    if seq > self.seq:
+                        entries.append(entry)
+                        self.seq = seq
+        except FileNotFoundError:
+            pass
+        return (state, entries)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, entries):
+        if not entries:
             return
-        r = requests.get(self.url, **self.requests_kwargs)
-        with open(self.path, 'wb') as f:
-            f.write(r.content)
+        if self.file is None:
+            self.file = open(self.journal_path, 'ab')
+        for entry in entries:
+            self.seq += 1
+            pickle.dump((self.seq, entry), self.file)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def compact(self, state):
+        dump_pickle((self.seq, state), self.path)
+        # Everything journaled so far is in the snapshot now.
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, 'wb')
+
+
+class Downloader:
+    # Shared download pool: one pooled HTTP session, at most `workers`
+    # downloads at a time and one download per path in flight. Files are
+    # streamed to a temporary file and renamed into place when complete,
+    # or handed to `store` (see imagestore.ImageStore) if set.
+    def __init__(self, workers=4, retries=3, backoff=2, timeout=30,
+                 store=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.inflight = {}  # path -> Future
+        self.lock = threading.Lock()
+        self.store = store
+
+    def download(self, url, path, requests_kwargs={}):
+        with self.lock:
+            future = self.inflight.get(path)
+            new = future is None
+            if new:
+                future = self.executor.submit(
+                    self.fetch, url, path, requests_kwargs)
+                self.inflight[path] = future
+        # A finished future runs the callback inline, which takes the lock.
+        if new:
+            future.add_done_callback(lambda f: self.done(path, f))
+        return future
+
+    def done(self, path, future):
+        with self.lock:
+            if self.inflight.get(path) is future:
+                del self.inflight[path]
+        if future.exception() is not None:
+            error("[Downloader]", "Failed", path, future.exception())
+
+    def fetch(self, url, path, requests_kwargs):
+        if os.path.exists(path):
+            print("[Downloader]", "Exists", path)
+            if self.store is not None:
+                self.store.touch(path)
+            return path
+        if self.store is not None and self.store.link_url(url, path):
+            return path
+        kwargs = {'timeout': self.timeout, **requests_kwargs}
+        for attempt in range(self.retries):
+            try:
+                self.stream(url, path, kwargs)
+                return path
+            except Exception:
+                if attempt + 1 >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def stream(self, url, path, kwargs):
+        r = self.session.get(url, stream=True, **kwargs)
+        try:
+            r.raise_for_status()
+            (fd, tmp_path) = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in r.iter_content(64 * 1024):
+                        f.write(chunk)
+                if self.store is not None:
+                    self.store.put(tmp_path, path, url)
+                else:
+                    os.replace(tmp_path, path)
+            except:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        finally:
+            r.close()
+
+
+downloader = Downloader()